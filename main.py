@@ -7,22 +7,49 @@
 # 5) 加上 /health（GET/HEAD）避免監控誤判（非必需但安全）
 
 import os
-import json
+import asyncio
 import base64
 import hmac
 import hashlib
-import random
-import string
+import logging
+import secrets
 import re
+import threading
+import time
+try:
+    import fcntl
+except ImportError:  # Windows 沒有 flock：WAL 只能給單一 worker 用
+    fcntl = None
+from concurrent.futures import ThreadPoolExecutor, Future
 from datetime import datetime, timedelta, timezone, date
-from typing import Dict, Any, Optional, List, Tuple
+from dataclasses import dataclass, field
+from functools import lru_cache
+from urllib.parse import quote
+from typing import Dict, Any, Optional, List, Sequence, Tuple
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from cachetools import TTLCache
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.responses import PlainTextResponse
 
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from google.auth.transport.requests import AuthorizedSession, Request as GoogleAuthRequest
+
+
+# =========================
+# Logging
+# =========================
+# logger 參數延後格式化：層級沒開的訊息不會組字串；uvicorn 會管自己的 logger，這裡只設 "uoo"
+logger = logging.getLogger("uoo")
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s"))
+    logger.addHandler(_log_handler)
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO").strip().upper() or "INFO")
+    logger.propagate = False
 
 
 # =========================
@@ -30,6 +57,7 @@ from googleapiclient.discovery import build
 # =========================
 CHANNEL_ACCESS_TOKEN = os.getenv("CHANNEL_ACCESS_TOKEN", "").strip()
 CHANNEL_SECRET = os.getenv("CHANNEL_SECRET", "").strip()
+CHANNEL_SECRET_BYTES = CHANNEL_SECRET.encode("utf-8")
 
 GSHEET_ID = os.getenv("GSHEET_ID", "").strip()
 GOOGLE_SERVICE_ACCOUNT_B64 = os.getenv("GOOGLE_SERVICE_ACCOUNT_B64", "").strip()
@@ -50,6 +78,8 @@ ADMIN_USER_IDS = [x.strip() for x in os.getenv("ADMIN_USER_IDS", "").split(",")
 
 TZ = timezone(timedelta(hours=8))  # Asia/Taipei
 LINE_API_BASE = "https://api.line.me/v2/bot/message"
+LINE_PROFILE_URL = "https://api.line.me/v2/bot/profile"
+SHEETS_API_BASE = "https://sheets.googleapis.com/v4/spreadsheets"
 
 PICKUP_ADDRESS = os.getenv("PICKUP_ADDRESS", "新竹縣竹北市隘口六街65號").strip()
 
@@ -82,6 +112,9 @@ PICKUP_NOTICE = os.getenv(
 ).strip()
 
 
+_INT_RE = re.compile(r"-?\d+")
+
+
 def safe_int_env(key: str, default: int) -> int:
     """
     Render / ENV 有時候會出現 '(3)' 這種字串，int() 會炸。
@@ -90,7 +123,7 @@ def safe_int_env(key: str, default: int) -> int:
     raw = (os.getenv(key, "") or "").strip()
     if not raw:
         return default
-    m = re.search(r"-?\d+", raw)
+    m = _INT_RE.search(raw)
     if not m:
         return default
     try:
@@ -119,39 +152,89 @@ app = FastAPI()
 # =========================
 # In-memory session store
 # =========================
-SESSIONS: Dict[str, Dict[str, Any]] = {}
-
-
-def get_session(user_id: str) -> Dict[str, Any]:
-    if user_id not in SESSIONS:
-        SESSIONS[user_id] = {
-            "ordering": False,
-            "state": "IDLE",
-
-            "cart": [],
-            "pending_item": None,
-            "pending_flavor": None,
-
-            "pickup_method": None,
-            "pickup_date": None,
-            "pickup_time": None,
-            "pickup_name": None,
-            "pickup_phone": None,
-            "pickup_phone_ok": False,
-
-            "delivery_date": None,
-            "delivery_name": None,
-            "delivery_phone": None,
-            "delivery_phone_ok": False,
-            "delivery_address": None,
-
-            "edit_mode": None,
-
-            # 防止「容易沒反應」：同一秒連點同一 postback 直接忽略
-            "last_postback_data": None,
-            "last_postback_ts": 0.0,
-        }
-    return SESSIONS[user_id]
+# ✅ 有上限 + 會過期：閒置超過 SESSION_TTL 秒的購物車自動清掉，記憶體不會一直長
+SESSION_TTL = safe_int_env("SESSION_TTL", 1800)
+# 預期同時在線的 session 數（平均分到各份的預算，不是硬上限；硬上限見 SESSION_SHARD_MAX）
+SESSION_EXPECTED = safe_int_env("SESSION_EXPECTED", 10000)
+# TTLCache 本身不是 thread-safe：get/set 都會順便清過期項目（會改內部 linked list），不能像 dict 一樣無鎖
+# → 切成 16 份、每份自己一把鎖：不同 user 大多落在不同份，不會全部排同一把鎖；背景清過期也一次只停一份
+# 鎖只包住一次查詢+放回，不會重入 → 用 Lock 就好（比 RLock 便宜）
+SESSION_SHARDS = 16
+# hash 分得不會剛好平均：每份給平均預算 ceil(SESSION_EXPECTED/16) 的 2 倍空間，不然某份先滿就會提早踢掉還在用的購物車
+# → 記憶體最多放到 2×SESSION_EXPECTED 個 session（預設 16×1250 = 20000）
+SESSION_SHARD_MAX = -(-SESSION_EXPECTED // SESSION_SHARDS) * 2
+_SESSION_SHARDS: List[Tuple[TTLCache, threading.Lock]] = [
+    (TTLCache(maxsize=SESSION_SHARD_MAX, ttl=SESSION_TTL), threading.Lock())
+    for _ in range(SESSION_SHARDS)
+]
+
+
+@dataclass(slots=True)
+class CartItem:
+    item_key: str
+    label: str
+    flavor: str  # 沒有口味就是 ""
+    qty: int
+    unit_price: int
+    subtotal: int
+
+    def set_qty(self, qty: int):
+        # 改數量一律走這裡：subtotal 跟著更新，不用整台購物車重算
+        self.qty = qty
+        self.subtotal = self.unit_price * qty
+
+
+@dataclass(slots=True)
+class Session:
+    # 欄位固定 → slots：每個使用者的 session 比 dict 省記憶體，屬性存取也較快
+    ordering: bool = False
+    state: str = "IDLE"
+
+    cart: List[CartItem] = field(default_factory=list)
+    cart_subtotal: int = 0  # recalc_cart 維護；結帳卡/寫單/回覆直接讀，不用每次重加
+    pending_item: Optional[str] = None
+    pending_flavor: Optional[str] = None
+
+    pickup_method: Optional[str] = None
+    pickup_date: Optional[str] = None
+    pickup_time: Optional[str] = None
+    pickup_name: Optional[str] = None
+    pickup_phone: Optional[str] = None
+    pickup_phone_ok: bool = False
+
+    delivery_date: Optional[str] = None
+    delivery_name: Optional[str] = None
+    delivery_phone: Optional[str] = None
+    delivery_phone_ok: bool = False
+    delivery_address: Optional[str] = None
+
+    edit_mode: Optional[str] = None
+
+    # 防止「容易沒反應」：同一秒連點同一 postback 直接忽略
+    last_postback_data: Optional[str] = None
+    last_postback_ts: float = 0.0
+
+
+def get_session(user_id: str) -> Session:
+    sessions, lock = _SESSION_SHARDS[hash(user_id) % SESSION_SHARDS]
+    with lock:
+        sess = sessions.get(user_id)
+        if sess is None:
+            sess = Session()
+        sessions[user_id] = sess  # 重新放回去 = 重算過期時間（正在用的購物車不會被清）
+    return sess
+
+
+# TTLCache 只在有人讀寫時才順便清過期項目；半夜沒人下單時由背景執行緒每分鐘清一次
+SESSION_GC_INTERVAL = 60
+
+
+def _session_gc_loop():
+    while True:
+        time.sleep(SESSION_GC_INTERVAL)
+        for sessions, lock in _SESSION_SHARDS:
+            with lock:
+                sessions.expire()
 
 
 # =========================
@@ -179,17 +262,38 @@ ITEMS = {
 # =========================
 # LINE API (no SDK)
 # =========================
-def line_headers() -> dict:
-    return {
-        "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}",
-        "Content-Type": "application/json",
-    }
-
-
-def line_reply(reply_token: str, messages: List[dict]):
-    if not CHANNEL_ACCESS_TOKEN:
-        return
-    # 保險：過濾空訊息（避免 LINE 400）
+# ✅ 共用同一個 Session：連到 api.line.me 的 TCP/TLS 連線會重複使用，不用每次回覆都重新握手
+# 授權 header 也在建立時設定一次，之後每個請求自動帶上
+EVENT_WORKERS = max(1, safe_int_env("EVENT_WORKERS", 4))  # 回覆：每個 event worker 一條
+PUSH_WORKERS = max(1, safe_int_env("PUSH_WORKERS", 4))    # 背景 push：每個執行緒一條
+LINE_HTTP = requests.Session()
+# 連線池跟同時打 LINE 的執行緒數對齊：worker 調大時連線也夠用，不會用完就丟、下次又重新握手
+# 重試：連線沒建起來（請求根本沒送出）一律重試；429/5xx 只重試 GET（profile）。
+# reply/push 是 POST，送出後失敗就不重送，避免客人收到兩次
+LINE_RETRY = Retry(
+    total=2,
+    connect=2,
+    read=0,
+    status=2,
+    backoff_factor=0.2,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset({"GET"}),
+    respect_retry_after_header=False,  # 不要讓 worker 照 Retry-After 睡很久
+    raise_on_status=False,             # 重試完還是失敗就照常回傳 response，由呼叫端看 status_code
+)
+LINE_HTTP.mount("https://", HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=EVENT_WORKERS + PUSH_WORKERS,
+    max_retries=LINE_RETRY,
+))
+LINE_HTTP.headers.update({
+    "Authorization": f"Bearer {CHANNEL_ACCESS_TOKEN}",
+    "Content-Type": "application/json",
+})
+
+
+# 保險：過濾空訊息（避免 LINE 400）
+def safe_messages(messages: List[dict]) -> List[dict]:
     safe_msgs = []
     for m in (messages or []):
         if not m:
@@ -199,47 +303,134 @@ def line_reply(reply_token: str, messages: List[dict]):
         if m.get("type") == "flex" and (not m.get("altText") or not m.get("contents")):
             continue
         safe_msgs.append(m)
+    return safe_msgs
+
+
+def line_reply(reply_token: str, messages: List[dict]):
+    if not CHANNEL_ACCESS_TOKEN:
+        return
+    safe_msgs = safe_messages(messages)
     if not safe_msgs:
         safe_msgs = [{"type": "text", "text": "收到～"}]
 
     payload = {"replyToken": reply_token, "messages": safe_msgs}
-    r = requests.post(
+    r = LINE_HTTP.post(
         f"{LINE_API_BASE}/reply",
-        headers=line_headers(),
-        data=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+        data=orjson.dumps(payload),  # orjson 直接輸出 UTF-8 bytes；固定卡片的 Fragment 原樣嵌入
         timeout=15,
     )
     if r.status_code >= 300:
-        print("[ERROR] reply failed:", r.status_code, r.text)
+        logger.error("reply failed: %s %s", r.status_code, r.text)
 
 
 def line_push(user_id: str, messages: List[dict]):
     if not CHANNEL_ACCESS_TOKEN:
         return
-    safe_msgs = []
-    for m in (messages or []):
-        if not m:
-            continue
-        if m.get("type") == "text" and not (m.get("text") or "").strip():
-            continue
-        if m.get("type") == "flex" and (not m.get("altText") or not m.get("contents")):
-            continue
-        safe_msgs.append(m)
+    safe_msgs = safe_messages(messages)
     if not safe_msgs:
         return
 
     payload = {"to": user_id, "messages": safe_msgs}
-    r = requests.post(
+    r = LINE_HTTP.post(
         f"{LINE_API_BASE}/push",
-        headers=line_headers(),
-        data=json.dumps(payload, ensure_ascii=False).encode("utf-8"),
+        data=orjson.dumps(payload),
         timeout=15,
     )
     if r.status_code >= 300:
-        print("[ERROR] push failed:", r.status_code, r.text)
+        logger.error("push failed: %s %s", r.status_code, r.text)
+
+
+LINE_MULTICAST_MAX = 500  # LINE multicast 一次最多 500 人
+
+
+def line_multicast(user_ids: Sequence[str], messages: List[dict]):
+    # 同一則訊息發給多人（例如所有管理員）：一次 API 呼叫，不用每人各 push 一次
+    if not CHANNEL_ACCESS_TOKEN or not user_ids:
+        return
+    safe_msgs = safe_messages(messages)
+    if not safe_msgs:
+        return
+
+    for i in range(0, len(user_ids), LINE_MULTICAST_MAX):
+        payload = {"to": list(user_ids[i:i + LINE_MULTICAST_MAX]), "messages": safe_msgs}
+        r = LINE_HTTP.post(
+            f"{LINE_API_BASE}/multicast",
+            data=orjson.dumps(payload),
+            timeout=15,
+        )
+        if r.status_code >= 300:
+            logger.error("multicast failed: %s %s", r.status_code, r.text)
+
+
+# ✅ push（通知管理員/客人）不影響回覆內容 → 丟到背景執行緒送，worker 不用等 LINE
+PUSH_POOL = ThreadPoolExecutor(max_workers=PUSH_WORKERS, thread_name_prefix="line-push")
+
+
+def _log_bg_error(fut: Future):
+    e = fut.exception()
+    if e:
+        logger.error("background push failed", exc_info=e)
+
+
+def run_in_background(fn, *args):
+    PUSH_POOL.submit(fn, *args).add_done_callback(_log_bg_error)
+
+
+# ✅ 顯示名稱快取：名字幾乎不會變，同一個 user 一小時內只問 LINE 一次
+PROFILE_CACHE: TTLCache = TTLCache(maxsize=10000, ttl=3600)
+# 查失敗（封鎖/非好友/LINE 暫時掛掉）也記 5 分鐘：不然這個人每個事件都會再打一次 profile API
+PROFILE_MISS_CACHE: TTLCache = TTLCache(maxsize=10000, ttl=300)
+_PROFILE_LOCK = threading.Lock()
+
+
+def _profile_miss(user_id: str) -> str:
+    with _PROFILE_LOCK:
+        PROFILE_MISS_CACHE[user_id] = True
+    return ""
+
+
+def get_display_name(user_id: str) -> str:
+    with _PROFILE_LOCK:
+        name = PROFILE_CACHE.get(user_id)
+        if name is None and user_id in PROFILE_MISS_CACHE:
+            name = ""
+    if name is not None:
+        return name
+    if not CHANNEL_ACCESS_TOKEN or not user_id:
+        return ""
+    try:
+        r = LINE_HTTP.get(f"{LINE_PROFILE_URL}/{user_id}", timeout=15)
+        if r.status_code >= 300:
+            logger.warning("get profile failed: %s %s", r.status_code, r.text)
+            return _profile_miss(user_id)
+        name = (orjson.loads(r.content).get("displayName") or "").strip()
+    except Exception as e:
+        logger.warning("get profile failed: %s", e)
+        return _profile_miss(user_id)
+    with _PROFILE_LOCK:
+        PROFILE_CACHE[user_id] = name
+    return name
+
+
+def cached_display_name(user_id: str) -> str:
+    # 建單只看快取，不在結帳路徑上同步打 profile API；沒抓到就先留空，背景補進快取給下一單用
+    with _PROFILE_LOCK:
+        name = PROFILE_CACHE.get(user_id)
+    if name is None:
+        prefetch_display_name(user_id)
+        return ""
+    return name
+
+
+def prefetch_display_name(user_id: str):
+    # 開始下單/結帳時先在背景把名字抓進快取，建單寫 A表 C 欄時就不用當場打 profile API
+    with _PROFILE_LOCK:
+        if user_id in PROFILE_CACHE or user_id in PROFILE_MISS_CACHE:
+            return
+    run_in_background(get_display_name, user_id)
 
 
-def msg_text(text: str, quick_items: Optional[List[dict]] = None) -> dict:
+def msg_text(text: str, quick_items: Optional[Sequence[dict]] = None) -> dict:
     m = {"type": "text", "text": text}
     if quick_items:
         m["quickReply"] = {"items": quick_items}
@@ -261,121 +452,640 @@ def msg_flex(alt_text: str, contents: dict) -> dict:
     return {"type": "flex", "altText": alt_text, "contents": contents}
 
 
+def frozen(node: Any) -> orjson.Fragment:
+    # 先序列化好的 JSON 片段：orjson 送出時原樣嵌入
+    return orjson.Fragment(orjson.dumps(node))
+
+
+def msg_flex_frozen(alt_text: str, contents: dict) -> dict:
+    """
+    固定卡片用：contents 先序列化成 JSON（orjson.Fragment），送出時原封不動嵌進 payload，
+    不用每次再走一遍整棵 dict
+    """
+    return msg_flex(alt_text, frozen(contents))
+
+
 # =========================
 # Google Sheets
 # =========================
+@lru_cache(maxsize=1)
 def load_service_account_info() -> Optional[dict]:
     if GOOGLE_SERVICE_ACCOUNT_B64:
         try:
-            raw = base64.b64decode(GOOGLE_SERVICE_ACCOUNT_B64.encode("utf-8")).decode("utf-8")
-            return json.loads(raw)
+            return orjson.loads(base64.b64decode(GOOGLE_SERVICE_ACCOUNT_B64))
         except Exception as e:
-            print("[ERROR] decode GOOGLE_SERVICE_ACCOUNT_B64 failed:", e)
+            logger.error("decode GOOGLE_SERVICE_ACCOUNT_B64 failed: %s", e)
             return None
     if GOOGLE_SERVICE_ACCOUNT_JSON:
         try:
-            return json.loads(GOOGLE_SERVICE_ACCOUNT_JSON)
+            return orjson.loads(GOOGLE_SERVICE_ACCOUNT_JSON)
         except Exception as e:
-            print("[ERROR] parse GOOGLE_SERVICE_ACCOUNT_JSON failed:", e)
+            logger.error("parse GOOGLE_SERVICE_ACCOUNT_JSON failed: %s", e)
             return None
     return None
 
 
-def get_sheets_service():
-    info = load_service_account_info()
-    if not info:
-        return None
-    scopes = ["https://www.googleapis.com/auth/spreadsheets"]
-    creds = service_account.Credentials.from_service_account_info(info, scopes=scopes)
-    return build("sheets", "v4", credentials=creds, cache_discovery=False)
+# ✅ Sheets 連線只建一次：直接打 REST API，不用 googleapiclient（省掉 discovery、httplib2 沒有連線池）
+# AuthorizedSession 是 requests.Session：TLS 連線會重複使用，token 快過期會自動 refresh
+_SHEETS_SESSION: Optional[AuthorizedSession] = None
+_SHEETS_SESSION_LOCK = threading.Lock()
+SHEETS_POOL_MAXSIZE = max(1, safe_int_env("SHEETS_POOL_MAXSIZE", 8))
+
+
+def get_sheets_session() -> Optional[AuthorizedSession]:
+    global _SHEETS_SESSION
+    if _SHEETS_SESSION is not None:
+        return _SHEETS_SESSION  # 建好之後就不用再搶鎖
+    with _SHEETS_SESSION_LOCK:
+        if _SHEETS_SESSION is None:
+            info = load_service_account_info()
+            if not info:
+                return None
+            scopes = ["https://www.googleapis.com/auth/spreadsheets"]
+            creds = service_account.Credentials.from_service_account_info(info, scopes=scopes)
+            session = AuthorizedSession(creds)
+            # 同時打 Sheets 的有：寫入 flusher、event workers、背景 push（查訂單）
+            # 連線池開夠大，才不會用完就丟、下次又重新握手
+            session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=SHEETS_POOL_MAXSIZE))
+            # body 一律自己用 orjson 序列化成 bytes 送（同 LINE_HTTP）
+            session.headers["Content-Type"] = "application/json"
+            _SHEETS_SESSION = session
+        return _SHEETS_SESSION
+
+
+@lru_cache(maxsize=32)
+def quoted_sheet_name(sheet_name: str) -> str:
+    # 分頁名稱一律加單引號（有空白/符號也能用），名稱裡的 ' 要寫成 ''；一次到位不用試好幾種格式
+    return "'" + sheet_name.replace("'", "''") + "'"
+
+
+# ✅ token 快到期前就在背景換新：不然每小時會有一個請求卡在 oauth2 的 refresh 上
+# （google-auth 在剩不到 3分45秒 時才會在請求當下 refresh，所以提前量要比這個大）
+SHEETS_TOKEN_REFRESH_MARGIN = 600  # 秒
+_TOKEN_REQUEST: Optional[GoogleAuthRequest] = None
+
+
+def refresh_sheets_token_if_needed() -> bool:
+    global _TOKEN_REQUEST
+    session = get_sheets_session()
+    if not session:
+        return False
+    creds = session.credentials
+    if creds.token and creds.expiry:
+        left = (creds.expiry - datetime.now(timezone.utc).replace(tzinfo=None)).total_seconds()
+        if left > SHEETS_TOKEN_REFRESH_MARGIN:
+            return False
+    if _TOKEN_REQUEST is None:
+        _TOKEN_REQUEST = GoogleAuthRequest()
+    creds.refresh(_TOKEN_REQUEST)
+    return True
+
+
+def _sheets_token_refresh_loop():
+    # 開機先拿 token + 抓好 sheetId：第一筆訂單 flush 時不用再多等這兩趟
+    try:
+        refresh_sheets_token_if_needed()
+        warm_sheet_ids()
+    except Exception as e:
+        logger.warning("sheets warm-up failed: %s", e)
+    while True:
+        time.sleep(60)
+        try:
+            refresh_sheets_token_if_needed()
+        except Exception as e:
+            logger.warning("sheets token refresh failed: %s", e)
 
 
-def sheet_append(sheet_name: str, row: List[Any]) -> bool:
-    if not GSHEET_ID:
-        print("[WARN] GSHEET_ID missing, skip append.")
-        return False
-    service = get_sheets_service()
-    if not service:
-        print("[WARN] Google Sheet env missing, skip append.")
-        return False
+def sheet_values_url(sheet_name: str, a1: str, suffix: str = "") -> str:
+    range_ = quote(f"{quoted_sheet_name(sheet_name)}!{a1}", safe="")
+    return f"{SHEETS_API_BASE}/{GSHEET_ID}/values/{range_}{suffix}"
+
+
+# 分頁名稱 → sheetId（appendCells 要用 id）；只在第一次 / 遇到沒看過的分頁時才查
+_SHEET_IDS: Dict[str, int] = {}
+_SHEET_IDS_LOCK = threading.Lock()
+_SHEET_IDS_FETCHED_AT = 0.0
+SHEET_IDS_REFETCH_MIN_INTERVAL = 60  # 秒：分頁真的不存在時，別每次 flush 都重抓一次 metadata
+
+
+def get_sheet_id(sheet_name: str) -> Optional[int]:
+    global _SHEET_IDS_FETCHED_AT
+    sid = _SHEET_IDS.get(sheet_name)
+    if sid is not None:
+        return sid
+    session = get_sheets_session()
+    if not session or not GSHEET_ID:
+        return None
+    with _SHEET_IDS_LOCK:
+        if (
+            sheet_name not in _SHEET_IDS
+            and time.monotonic() - _SHEET_IDS_FETCHED_AT >= SHEET_IDS_REFETCH_MIN_INTERVAL
+        ):
+            _SHEET_IDS_FETCHED_AT = time.monotonic()
+            try:
+                r = session.get(
+                    f"{SHEETS_API_BASE}/{GSHEET_ID}",
+                    params={"fields": "sheets.properties(sheetId,title)"},
+                    timeout=15,
+                )
+                r.raise_for_status()
+                for sh in orjson.loads(r.content).get("sheets", []):
+                    props = sh.get("properties") or {}
+                    _SHEET_IDS[props.get("title", "")] = props.get("sheetId")
+            except Exception as e:
+                logger.warning("load sheet ids failed: %s", e)
+        return _SHEET_IDS.get(sheet_name)
+
+
+def warm_sheet_ids():
+    # 第一次查就會一次抓回所有分頁；後面幾張都是直接命中
+    for sheet_name in (SHEET_A_NAME, SHEET_B_NAME, SHEET_C_NAME, SHEET_CASHFLOW_NAME):
+        get_sheet_id(sheet_name)
+
+
+def _cell_data(v: Any) -> dict:
+    # 跟 valueInputOption=RAW 一樣：字串照字串存、數字照數字存，不做公式/日期解析
+    if v is None or v == "":
+        return {}
+    if isinstance(v, bool):
+        return {"userEnteredValue": {"boolValue": v}}
+    if isinstance(v, (int, float)):
+        return {"userEnteredValue": {"numberValue": v}}
+    return {"userEnteredValue": {"stringValue": str(v)}}
+
+
+def _is_retryable_status(status: int) -> bool:
+    # 0 = 連線/逾時（請求沒送到或沒回應）；429 = 額度；5xx = Google 那邊暫時出問題
+    return status == 0 or status == 429 or status >= 500
+
+
+def _post_append_requests(session: AuthorizedSession, requests_: List[dict]) -> Optional[int]:
+    """
+    送出一個 batchUpdate：成功回 None，失敗回 HTTP status（連線/逾時錯誤回 0）
+    """
     try:
-        range_ = f"'{sheet_name}'!A1"
-        body = {"values": [row]}
-        service.spreadsheets().values().append(
-            spreadsheetId=GSHEET_ID,
-            range=range_,
-            valueInputOption="RAW",
-            insertDataOption="INSERT_ROWS",
-            body=body,
-        ).execute()
-        return True
+        r = session.post(
+            f"{SHEETS_API_BASE}/{GSHEET_ID}:batchUpdate",
+            data=orjson.dumps({"requests": requests_}),
+            timeout=15,
+        )
     except Exception as e:
-        print(f"[ERROR] append to {sheet_name} failed:", e)
-        return False
+        logger.error("batch append failed: %s", e)
+        return 0
+    if r.status_code >= 300:
+        logger.error("batch append failed: %s %s", r.status_code, r.text[:500])
+        return r.status_code
+    return None
+
+
+def sheet_append_batch(
+    batch: Dict[str, List[List[Any]]],
+) -> Tuple[Dict[str, List[List[Any]]], Dict[str, List[List[Any]]]]:
+    """
+    多張表的列一次送出：一個 spreadsheets:batchUpdate，每張表一個 appendCells
+    回傳 (retry, dead)，都是 {sheet_name: rows}（全部成功 = 兩個都是空 dict）：
+    retry = 晚點重送可能會成功（連線失敗 / 429 / 5xx / 分頁暫時找不到）
+    dead  = 重送也不會成功（400 資料有問題、403 權限…），不要再塞回佇列
+    """
+    session = get_sheets_session()
+    if not session or not GSHEET_ID:
+        logger.warning("Google Sheet env missing, skip append.")
+        return batch, {}
+
+    retry: Dict[str, List[List[Any]]] = {}
+    dead: Dict[str, List[List[Any]]] = {}
+    by_sheet: List[Tuple[str, dict]] = []
+    for sheet_name, rows in batch.items():
+        sid = get_sheet_id(sheet_name)
+        if sid is None:
+            logger.error("sheet not found: %s", sheet_name)
+            retry[sheet_name] = rows  # 分頁可能還沒建好；flusher 有重送上限
+            continue
+        by_sheet.append((sheet_name, {
+            "appendCells": {
+                "sheetId": sid,
+                "rows": [{"values": [_cell_data(v) for v in row]} for row in rows],
+                "fields": "userEnteredValue",
+            }
+        }))
+    if not by_sheet:
+        return retry, dead
+
+    status = _post_append_requests(session, [req for _, req in by_sheet])
+    if status is None:
+        return retry, dead
+    if _is_retryable_status(status) or len(by_sheet) == 1:
+        target = retry if _is_retryable_status(status) else dead
+        for sheet_name, _ in by_sheet:
+            target[sheet_name] = batch[sheet_name]
+        return retry, dead
+
+    # batchUpdate 是整包成功或整包失敗：不知道是哪張表的列有問題 → 每張表各送一次，只挑出真的送不進去的
+    for sheet_name, req in by_sheet:
+        status = _post_append_requests(session, [req])
+        if status is None:
+            continue
+        (retry if _is_retryable_status(status) else dead)[sheet_name] = batch[sheet_name]
+    return retry, dead
 
 
 def sheet_read_range(sheet_name: str, a1: str) -> List[List[str]]:
-    service = get_sheets_service()
-    if not service or not GSHEET_ID:
+    session = get_sheets_session()
+    if not session or not GSHEET_ID:
+        return []
+    try:
+        r = session.get(sheet_values_url(sheet_name, a1), timeout=15)
+        r.raise_for_status()
+        return orjson.loads(r.content).get("values", []) or []
+    except Exception as e:
+        logger.warning("read range failed %s %s: %s", sheet_name, a1, e)
+        return []
+
+
+def sheet_read_columns(sheet_name: str, a1_list: Sequence[str]) -> List[List[str]]:
+    """
+    一次 values:batchGet 讀同一張表的好幾欄（majorDimension=COLUMNS）
+    回傳跟 a1_list 同順序、每欄一個 list（尾端空白格 Sheets 不會回）
+    """
+    session = get_sheets_session()
+    if not session or not GSHEET_ID:
         return []
+    name = quoted_sheet_name(sheet_name)
     try:
-        r = service.spreadsheets().values().get(
-            spreadsheetId=GSHEET_ID,
-            range=f"'{sheet_name}'!{a1}"
-        ).execute()
-        return r.get("values", []) or []
+        r = session.get(
+            f"{SHEETS_API_BASE}/{GSHEET_ID}/values:batchGet",
+            params={"ranges": [f"{name}!{a1}" for a1 in a1_list], "majorDimension": "COLUMNS"},
+            timeout=15,
+        )
+        r.raise_for_status()
+        value_ranges = orjson.loads(r.content).get("valueRanges", [])
+        return [(vr.get("values") or [[]])[0] for vr in value_ranges]
     except Exception as e:
-        print(f"[WARN] read range failed {sheet_name} {a1}:", e)
+        logger.warning("read columns failed %s %s: %s", sheet_name, a1_list, e)
         return []
 
 
 def sheet_update_a1(sheet_name: str, a1: str, values_2d: List[List[Any]]) -> bool:
-    service = get_sheets_service()
-    if not service or not GSHEET_ID:
+    session = get_sheets_session()
+    if not session or not GSHEET_ID:
         return False
     try:
-        service.spreadsheets().values().update(
-            spreadsheetId=GSHEET_ID,
-            range=f"'{sheet_name}'!{a1}",
-            valueInputOption="RAW",
-            body={"values": values_2d},
-        ).execute()
+        r = session.put(
+            sheet_values_url(sheet_name, a1),
+            params={"valueInputOption": "RAW"},
+            data=orjson.dumps({"values": values_2d}),
+            timeout=15,
+        )
+        r.raise_for_status()
         return True
     except Exception as e:
-        print(f"[ERROR] update range failed {sheet_name} {a1}:", e)
+        logger.error("update range failed %s %s: %s", sheet_name, a1, e)
         return False
 
 
+# =========================
+# Sheets 寫入佇列（批次 append）
+# =========================
+# 下單/狀態的列先進佇列，背景執行緒每次把同一張表的列合併成一個 append：
+# 累積到 SHEET_FLUSH_MAX_ROWS 列、或第一列已等了 SHEET_FLUSH_MAX_WAIT 秒就送出。
+SHEET_FLUSH_MAX_ROWS = safe_int_env("SHEET_FLUSH_MAX_ROWS", 20)
+SHEET_FLUSH_MAX_WAIT = safe_int_env("SHEET_FLUSH_MAX_WAIT", 2)  # 秒
+
+_PENDING_ROWS: Dict[str, List[List[Any]]] = {}
+_PENDING_COUNT = 0
+_PENDING_SINCE = 0.0  # 佇列中第一列進來的時間（0 = 佇列是空的）
+_PENDING_LOCK = threading.Lock()
+_FLUSH_WAKE = threading.Event()
+# 一次只能有一個 flush（背景 flusher / shutdown）：WAL 是照佇列重寫的，
+# 兩個 flush 交錯時，後面那個會把前一個還在送的列從 WAL 洗掉
+_FLUSH_LOCK = threading.Lock()
+_INFLIGHT_ROWS: Dict[str, List[List[Any]]] = {}  # flush 正在送、還沒確定寫進表的那批（拿著 _PENDING_LOCK 才能換）
+
+# 同一張表連續送失敗超過這個次數（每次間隔加倍，最多 60 秒）就不再重送，改寫進 dead-letter 檔
+SHEET_FLUSH_MAX_RETRIES = safe_int_env("SHEET_FLUSH_MAX_RETRIES", 8)
+_RETRY_COUNTS: Dict[str, int] = {}  # sheet_name → 連續失敗次數（拿著 _PENDING_LOCK 才能改）
+
+# 送不進去的列（格式同 WAL：一行一筆 [sheet_name, row]）留在這裡給人工補登，不會卡住後面的訂單
+ORDER_DEAD_LETTER_PATH = os.getenv("ORDER_DEAD_LETTER_PATH", "/tmp/orders.dead.jsonl").strip()
+
+# ✅ write-behind log：列進佇列前先寫到本機檔（一行一筆 JSON），
+# Sheets 掛掉或程式重啟時訂單不會不見；每次送完只留還沒送出的列，啟動時把殘留的補送。
+# 多個 uvicorn worker 不能共用同一個檔：每個 process 用 flock 搶一個 slot
+# （orders.wal、orders.1.wal、orders.2.wal…），process 結束鎖就自動放掉，重啟後再搶回來。
+ORDER_WAL_PATH = os.getenv("ORDER_WAL_PATH", "/tmp/orders.wal").strip()
+ORDER_WAL_SLOTS = 32
+_ORDER_WAL = None  # startup 時打開（留空 ORDER_WAL_PATH = 不用 WAL）
+
+
+def _order_wal_slot_path(i: int) -> str:
+    if i == 0:
+        return ORDER_WAL_PATH
+    root, ext = os.path.splitext(ORDER_WAL_PATH)
+    return f"{root}.{i}{ext}"
+
+
+def _try_lock_wal(f) -> bool:
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False  # 別的 worker 正在用
+
+
+def _read_wal_rows(f) -> List[Tuple[str, List[Any]]]:
+    f.seek(0)
+    out: List[Tuple[str, List[Any]]] = []
+    for line in f.read().splitlines():
+        try:
+            sheet_name, row = orjson.loads(line)
+        except Exception:
+            continue  # 寫到一半被砍掉的最後一行
+        out.append((sheet_name, row))
+    return out
+
+
+def open_order_wal():
+    """
+    搶一個沒人用的 WAL slot 打開，把上次沒送出的列放回佇列；
+    沒人鎖的其他 slot（例如 worker 變少了）也一起接手，不會有列被留在沒人讀的檔裡
+    """
+    global _ORDER_WAL, _PENDING_COUNT, _PENDING_SINCE
+    if not ORDER_WAL_PATH:
+        return
+    wal = None
+    for i in range(ORDER_WAL_SLOTS if fcntl is not None else 1):
+        f = open(_order_wal_slot_path(i), "a+b", buffering=0)
+        if _try_lock_wal(f):
+            wal = f
+            break
+        f.close()
+    if wal is None:
+        logger.error("no free order WAL slot under %s, WAL disabled", ORDER_WAL_PATH)
+        return
+
+    replay: List[Tuple[str, List[Any]]] = []
+    orphans = []
+    try:
+        replay.extend(_read_wal_rows(wal))
+        if fcntl is not None:
+            for i in range(ORDER_WAL_SLOTS):
+                path = _order_wal_slot_path(i)
+                if path == wal.name or not os.path.exists(path):
+                    continue
+                f = open(path, "r+b")
+                if not _try_lock_wal(f):
+                    f.close()
+                    continue
+                replay.extend(_read_wal_rows(f))
+                orphans.append(f)
+    except Exception:
+        logger.exception("read order WAL failed")
+
+    with _PENDING_LOCK:
+        _ORDER_WAL = wal
+        for sheet_name, row in replay:
+            _PENDING_ROWS.setdefault(sheet_name, []).append(row)
+        if replay:
+            _PENDING_COUNT += len(replay)
+            _PENDING_SINCE = time.monotonic()
+        _rewrite_order_wal_locked()  # 接手的列寫進自己的 WAL，順便把寫到一半的尾巴清掉
+    for f in orphans:
+        # 列已經在自己的 WAL 了，才把別的 slot 清空
+        try:
+            f.truncate(0)
+        except Exception:
+            logger.exception("truncate orphan order WAL failed")
+        f.close()
+    if replay:
+        logger.info("replay %d rows from order WAL (%s)", len(replay), wal.name)
+        _FLUSH_WAKE.set()
+
+
+def _rewrite_order_wal_locked():
+    # 呼叫端要拿著 _PENDING_LOCK：WAL 只留還在佇列裡的列（通常就是清空）
+    if _ORDER_WAL is None:
+        return
+    try:
+        _ORDER_WAL.truncate(0)
+        if _PENDING_COUNT:
+            _ORDER_WAL.write(b"".join(
+                orjson.dumps([sheet_name, row]) + b"\n"
+                for sheet_name, rows in _PENDING_ROWS.items()
+                for row in rows
+            ))
+    except Exception:
+        logger.exception("rewrite order WAL failed")
+
+
+def sheet_enqueue(sheet_name: str, row: List[Any]) -> bool:
+    return sheet_enqueue_rows(sheet_name, [row])
+
+
+def sheet_enqueue_rows(sheet_name: str, rows: List[List[Any]]) -> bool:
+    """
+    同一張表的多列一次排進佇列（一次鎖、一次 WAL write）；送出時本來就跟其他列合成同一個 batchUpdate
+    """
+    global _PENDING_COUNT, _PENDING_SINCE
+    if not rows:
+        return True
+    if not GSHEET_ID or not get_sheets_session():
+        # 排不進佇列也不能丟：先落地到 dead-letter 檔，由呼叫端決定要不要通知管理員
+        logger.warning("Google Sheet env missing, skip append.")
+        dead_letter_rows({sheet_name: rows}, notify=False)
+        return False
+    with _PENDING_LOCK:
+        if _ORDER_WAL is not None:
+            try:
+                _ORDER_WAL.write(b"".join(orjson.dumps([sheet_name, row]) + b"\n" for row in rows))
+            except Exception:
+                logger.exception("order WAL write failed")
+        first = not _PENDING_SINCE
+        _PENDING_ROWS.setdefault(sheet_name, []).extend(rows)
+        _PENDING_COUNT += len(rows)
+        if first:
+            _PENDING_SINCE = time.monotonic()
+        full = _PENDING_COUNT >= SHEET_FLUSH_MAX_ROWS
+    if first or full:
+        _FLUSH_WAKE.set()  # 叫醒背景執行緒：開始倒數 / 立刻送出
+    return True
+
+
+def dead_letter_rows(dead: Dict[str, List[List[Any]]], notify: bool = True) -> bool:
+    """
+    重送也不會成功的列：寫進 dead-letter 檔、通知管理員，之後就從佇列/WAL 拿掉
+    回傳 True = 有存到檔案（False = 只留在 log）
+    """
+    summary = "、".join(f"{sheet_name} {len(rows)} 列" for sheet_name, rows in dead.items())
+    logger.error("sheet rows dead-lettered (%s) -> %s", summary, ORDER_DEAD_LETTER_PATH or "log only")
+    data = b"".join(orjson.dumps([sheet_name, row]) + b"\n" for sheet_name, rows in dead.items() for row in rows)
+    saved = False
+    if ORDER_DEAD_LETTER_PATH:
+        try:
+            with open(ORDER_DEAD_LETTER_PATH, "ab") as f:
+                f.write(data)
+            saved = True
+        except Exception:
+            logger.exception("write dead-letter file failed")
+    if not saved:
+        logger.error("dead-lettered rows: %s", data.decode("utf-8"))
+
+    if notify and ADMIN_USER_IDS:
+        where = f"已存到 {ORDER_DEAD_LETTER_PATH}" if saved else "內容在伺服器 log"
+        try:
+            line_multicast(ADMIN_USER_IDS, [msg_text(
+                f"⚠️ 表單寫入失敗：{summary}\n{where}，請檢查 Sheet 名稱/權限/欄位後手動補登。"
+            )])
+        except Exception:
+            logger.exception("notify admins of dead-lettered rows failed")
+    return saved
+
+
+def flush_pending_rows() -> bool:
+    """
+    把佇列內的列送出（所有表合成一個 batchUpdate）
+    暫時性失敗的表放回佇列下次再送（有次數上限）；送不進去的改寫 dead-letter 檔
+    回傳 True = 沒有要重送的列
+    """
+    with _FLUSH_LOCK:  # 取出→送出→重寫 WAL 整段不能跟別的 flush 交錯
+        return _flush_pending_rows_locked()
+
+
+def _flush_pending_rows_locked() -> bool:
+    global _PENDING_ROWS, _PENDING_COUNT, _PENDING_SINCE, _INFLIGHT_ROWS
+    with _PENDING_LOCK:
+        batch = _PENDING_ROWS
+        _INFLIGHT_ROWS = batch
+        _PENDING_ROWS = {}
+        _PENDING_COUNT = 0
+        _PENDING_SINCE = 0.0
+    if not batch:
+        return True
+
+    retry, dead = sheet_append_batch(batch)
+
+    with _PENDING_LOCK:
+        for sheet_name in batch:
+            if sheet_name not in retry:
+                _RETRY_COUNTS.pop(sheet_name, None)
+        for sheet_name in list(retry):
+            n = _RETRY_COUNTS.get(sheet_name, 0) + 1
+            if n > SHEET_FLUSH_MAX_RETRIES:
+                dead[sheet_name] = retry.pop(sheet_name)
+                _RETRY_COUNTS.pop(sheet_name, None)
+            else:
+                _RETRY_COUNTS[sheet_name] = n
+
+    if dead:
+        dead_letter_rows(dead)  # 先落地到 dead-letter 檔，再從 WAL 拿掉
+
+    with _PENDING_LOCK:
+        for sheet_name, rows in retry.items():
+            _PENDING_ROWS[sheet_name] = rows + _PENDING_ROWS.get(sheet_name, [])
+            _PENDING_COUNT += len(rows)
+        if retry:
+            _PENDING_SINCE = time.monotonic()
+        _INFLIGHT_ROWS = {}
+        _rewrite_order_wal_locked()  # 不管全部成功或部分失敗，WAL 都只留還在佇列裡的列
+    return not retry
+
+
+def notify_admins_order_not_queued(order_id: str):
+    logger.error("order %s not queued for Google Sheet (env missing)", order_id)
+    if not ADMIN_USER_IDS:
+        return
+    where = f"已存到 {ORDER_DEAD_LETTER_PATH}" if ORDER_DEAD_LETTER_PATH else "內容在伺服器 log"
+    run_in_background(line_multicast, ADMIN_USER_IDS, [msg_text(
+        f"⚠️ 訂單 {order_id} 沒寫進表單（Google Sheet 設定/憑證有問題）\n{where}，請修好設定後手動補登。"
+    )])
+
+
+def order_row_pending(order_id: str) -> bool:
+    # A表那列還在佇列裡（或正在送）：表上查不到，但不是「沒有這筆訂單」
+    with _PENDING_LOCK:
+        for rows in (_PENDING_ROWS.get(SHEET_A_NAME), _INFLIGHT_ROWS.get(SHEET_A_NAME)):
+            for row in rows or ():
+                if len(row) > 3 and row[3] == order_id:  # D order_id
+                    return True
+    return False
+
+
+def _sheet_flush_loop():
+    fails = 0
+    while True:
+        with _PENDING_LOCK:
+            since = _PENDING_SINCE
+            full = _PENDING_COUNT >= SHEET_FLUSH_MAX_ROWS
+        waited = time.monotonic() - since
+        if since and (full or waited >= SHEET_FLUSH_MAX_WAIT):
+            if flush_pending_rows():
+                fails = 0
+            else:
+                # 寫入失敗先緩一下（間隔加倍），避免狂打 API
+                fails += 1
+                time.sleep(min(SHEET_FLUSH_MAX_WAIT * 2 ** fails, 60))
+            continue
+        _FLUSH_WAKE.wait(SHEET_FLUSH_MAX_WAIT - waited if since else None)
+        _FLUSH_WAKE.clear()
+
+
 # =========================
 # Settings: 公休
 # =========================
-def parse_int_list(s: str) -> List[int]:
-    out = []
+def parse_int_set(s: str) -> frozenset:
+    out = set()
     for x in (s or "").split(","):
         x = x.strip()
         if not x:
             continue
         try:
-            out.append(int(x))
+            out.add(int(x))
         except:
             pass
-    return out
+    return frozenset(out)
 
 
-def parse_date_set(s: str) -> set:
-    out = set()
-    for x in (s or "").split(","):
-        x = x.strip()
-        if not x:
-            continue
-        out.add(x)
-    return out
+def parse_date_set(s: str) -> frozenset:
+    return frozenset(filter(None, (x.strip() for x in (s or "").split(","))))
+
+
+# ENV 啟動後不會變：載入時就 parse 好（frozenset 可直接當日期快取的 key）
+ENV_CLOSED_WEEKDAY_SET = parse_int_set(ENV_CLOSED_WEEKDAYS)
+ENV_CLOSED_DATE_SET = parse_date_set(ENV_CLOSED_DATES)
+
+
+# ✅ settings 表不會常改：讀一次快取 SETTINGS_TTL 秒（選取貨方式/日期/建單都會用到）
+# 改完表想馬上生效：管理員在後台卡片按「重新讀取設定」（ADMIN:RELOAD）
+SETTINGS_TTL = safe_int_env("SETTINGS_TTL", 60)
+_SETTINGS_CACHE: Optional[Dict[str, Any]] = None
+_SETTINGS_LOADED_AT = 0.0
+_SETTINGS_LOCK = threading.Lock()
 
 
 def load_settings() -> Dict[str, Any]:
+    global _SETTINGS_CACHE, _SETTINGS_LOADED_AT
+    cached = _SETTINGS_CACHE
+    if cached is not None and time.monotonic() - _SETTINGS_LOADED_AT < SETTINGS_TTL:
+        return cached
+    with _SETTINGS_LOCK:
+        # 等鎖的時候別人可能已經讀好了
+        if _SETTINGS_CACHE is None or time.monotonic() - _SETTINGS_LOADED_AT >= SETTINGS_TTL:
+            _SETTINGS_CACHE = read_settings()
+            _SETTINGS_LOADED_AT = time.monotonic()
+        return _SETTINGS_CACHE
+
+
+def invalidate_settings():
+    global _SETTINGS_CACHE
+    with _SETTINGS_LOCK:
+        _SETTINGS_CACHE = None
+
+
+def read_settings() -> Dict[str, Any]:
     settings = {
-        "closed_weekdays": parse_int_list(ENV_CLOSED_WEEKDAYS),
-        "closed_dates": parse_date_set(ENV_CLOSED_DATES),
+        "closed_weekdays": ENV_CLOSED_WEEKDAY_SET,
+        "closed_dates": ENV_CLOSED_DATE_SET,
         "min_days": MIN_DAYS,
         "max_days": MAX_DAYS,
     }
@@ -391,7 +1101,7 @@ def load_settings() -> Dict[str, Any]:
                 if not k:
                     continue
                 if k == "closed_weekdays":
-                    settings["closed_weekdays"] = parse_int_list(v)
+                    settings["closed_weekdays"] = parse_int_set(v)
                 elif k == "closed_dates":
                     settings["closed_dates"] = parse_date_set(v)
                 elif k == "min_days":
@@ -405,7 +1115,7 @@ def load_settings() -> Dict[str, Any]:
                     except:
                         pass
     except Exception as e:
-        print("[INFO] settings sheet not loaded, use ENV:", e)
+        logger.info("settings sheet not loaded, use ENV: %s", e)
 
     return settings
 
@@ -417,7 +1127,7 @@ def weekday_user_to_py(wd: int) -> int:
 
 
 def is_closed(d: date, settings: Dict[str, Any]) -> bool:
-    ymd = d.strftime("%Y-%m-%d")
+    ymd = fmt_ymd(d)
     if ymd in settings["closed_dates"]:
         return True
     for wd in settings["closed_weekdays"]:
@@ -426,68 +1136,121 @@ def is_closed(d: date, settings: Dict[str, Any]) -> bool:
     return False
 
 
-def fmt_md_date(dt: datetime) -> str:
-    wk = "一二三四五六日"[dt.weekday()]
-    return f"{dt.month}/{dt.day}（{wk}）"
+def fmt_ymd(d: date) -> str:
+    # 比 strftime("%Y-%m-%d") 快，日期清單/對帳都會大量呼叫
+    return f"{d.year:04d}-{d.month:02d}-{d.day:02d}"
+
+
+_WEEKDAY_ZH = ("一", "二", "三", "四", "五", "六", "日")  # date.weekday()：週一 = 0
+
+
+def fmt_md_date(dt: date) -> str:
+    return f"{dt.month}/{dt.day}（{_WEEKDAY_ZH[dt.weekday()]}）"
 
 
-def build_available_date_buttons(settings: Dict[str, Any]) -> List[Tuple[str, str]]:
-    today = datetime.now(TZ).replace(hour=0, minute=0, second=0, microsecond=0)
+@lru_cache(maxsize=8)
+def _available_dates(
+    today: date,
+    closed_weekdays: frozenset,
+    closed_dates: frozenset,
+    min_days: int,
+    max_days: int,
+) -> Tuple[Tuple[Tuple[str, str], ...], frozenset]:
+    """
+    可選日期（按鈕 + 日期集合）：同一天、同一組公休設定只算一次
+    """
+    settings = {"closed_weekdays": closed_weekdays, "closed_dates": closed_dates}
     out = []
-    for i in range(settings["min_days"], settings["max_days"] + 1):
+    for i in range(min_days, max_days + 1):
         d = today + timedelta(days=i)
-        if not is_closed(d.date(), settings):
-            out.append((fmt_md_date(d), d.strftime("%Y-%m-%d")))
-    return out
+        if not is_closed(d, settings):
+            out.append((fmt_md_date(d), fmt_ymd(d)))
+    return tuple(out), frozenset(ymd for _, ymd in out)
+
+
+def _available_dates_today(settings: Dict[str, Any]) -> Tuple[Tuple[Tuple[str, str], ...], frozenset]:
+    return _available_dates(
+        today_tw(),
+        settings["closed_weekdays"],
+        settings["closed_dates"],
+        settings["min_days"],
+        settings["max_days"],
+    )
+
+
+def build_available_date_buttons(settings: Dict[str, Any]) -> Tuple[Tuple[str, str], ...]:
+    return _available_dates_today(settings)[0]
+
+
+def is_available_date(ymd: str, settings: Dict[str, Any]) -> bool:
+    return ymd in _available_dates_today(settings)[1]
+
+
+# 日期按鈕一天（或 settings 一改）才變一次 → 同一組日期的 quick reply 只組一次；回傳 tuple，呼叫端不要改內容
+@lru_cache(maxsize=8)
+def _date_quick_items(date_buttons: Tuple[Tuple[str, str], ...]) -> Tuple[dict, ...]:
+    return tuple(quick_postback(lbl, f"PB:DATE:{ymd}", display_text=lbl) for (lbl, ymd) in date_buttons)
+
+
+def build_date_quick_items(settings: Dict[str, Any]) -> Tuple[dict, ...]:
+    return _date_quick_items(build_available_date_buttons(settings))
+
+
+PICKUP_TIME_QUICK = tuple(quick_postback(s, f"PB:TIME:{s}", display_text=s) for s in PICKUP_SLOTS)
 
 
 # =========================
 # Helpers
 # =========================
+def today_tw() -> date:
+    return datetime.now(TZ).date()
+
+
 def now_str() -> str:
-    return datetime.now(TZ).strftime("%Y-%m-%d %H:%M:%S")
+    n = datetime.now(TZ)
+    return f"{fmt_ymd(n)} {n.hour:02d}:{n.minute:02d}:{n.second:02d}"
+
+
+@lru_cache(maxsize=2)
+def _order_id_day(d: date) -> str:
+    return f"{d.year:04d}{d.month:02d}{d.day:02d}"
 
 
 def gen_order_id() -> str:
-    d = datetime.now(TZ).strftime("%Y%m%d")
-    suffix = "".join(random.choices(string.digits, k=4))
-    return f"UOO-{d}-{suffix}"
+    # 日期字串一天只組一次；尾碼一次取 0～9999 再補零（不用逐位 random.choice）
+    d = _order_id_day(today_tw())
+    return f"UOO-{d}-{secrets.randbelow(10000):04d}"
 
 
-def cart_total(cart: List[dict]) -> int:
-    return sum(int(x.get("subtotal", 0)) for x in cart)
+def cart_total(cart: List[CartItem]) -> int:
+    return sum(x.subtotal for x in cart)
 
 
 def shipping_fee(total: int) -> int:
     return 0 if total >= 2500 else 180
 
 
-def recalc_cart(sess: dict):
-    for x in sess["cart"]:
-        x["subtotal"] = int(x["unit_price"]) * int(x["qty"])
+def recalc_cart(sess: Session):
+    # 每列 subtotal 在建立 / set_qty 時就算好了，這裡只要加總
+    sess.cart_subtotal = cart_total(sess.cart)
 
 
-def find_cart_line_label(x: dict) -> str:
-    name = x["label"]
-    if x.get("flavor"):
-        name += f"（{x['flavor']}）"
-    qty = x["qty"]
-    unit = x["unit_price"]
-    sub = x["subtotal"]
+def find_cart_line_label(x: CartItem) -> str:
+    name = x.label
+    if x.flavor:
+        name += f"（{x.flavor}）"
+    qty = x.qty
+    unit = x.unit_price
+    sub = x.subtotal
     return f"{name} ×{qty}（{unit}/單位）＝{sub}"
 
 
-def cart_readable_text(cart: List[dict]) -> str:
-    parts = []
-    for x in cart:
-        label = x["label"]
-        qty = x["qty"]
-        flavor = (x.get("flavor") or "").strip()
-        if flavor:
-            parts.append(f"{label}｜{qty}｜{flavor}")
-        else:
-            parts.append(f"{label}｜{qty}")
-    return "；".join(parts)
+def cart_readable_text(cart: List[CartItem]) -> str:
+    # flavor 一定有（沒口味就是 ""，口味來自 ITEMS 的清單）
+    return "；".join([
+        f"{x.label}｜{x.qty}｜{x.flavor}" if x.flavor else f"{x.label}｜{x.qty}"
+        for x in cart
+    ])
 
 
 def is_phone_digits(s: str) -> bool:
@@ -533,26 +1296,32 @@ def flex_menu_view_only() -> dict:
     }
 
 
-def flex_product_menu(ordering: bool) -> dict:
-    def btn(label: str, data: str, enabled: bool = True) -> dict:
-        return {
-            "type": "button",
-            "style": "primary" if enabled else "secondary",
-            "action": {"type": "postback", "label": label, "data": data, "displayText": label},
-            "height": "sm",
-        }
+def _item_button(item_key: str, meta: dict, enabled: bool) -> dict:
+    label = f"{meta['label']}｜NT${meta['unit_price']}"
+    if meta["step"] > 1:
+        # 有固定倍數的品項把可選數量列出來，例如達克瓦茲（2/4/6/8）
+        label += "（" + "/".join(str(q) for q in range(meta["min_qty"], meta["max_qty"] + 1, meta["step"])) + "）"
+    return {
+        "type": "button",
+        "style": "primary" if enabled else "secondary",
+        "action": {"type": "postback", "label": label, "data": f"PB:ITEM:{item_key}", "displayText": label},
+        "height": "sm",
+    }
+
+
+# 商品按鈕從 ITEMS 產生（改價/加品項只要改 ITEMS），載入時就建好兩組
+_ITEM_BUTTONS_ORDERING = tuple(_item_button(k, meta, True) for k, meta in ITEMS.items())
+_ITEM_BUTTONS_BROWSING = tuple(_item_button(k, meta, False) for k, meta in ITEMS.items())
 
-    disable = not ordering
+
+def flex_product_menu(ordering: bool) -> dict:
     return {
         "type": "bubble",
         "size": "mega",
         "body": {"type": "box", "layout": "vertical", "spacing": "md", "contents": [
             {"type": "text", "text": "請選擇商品", "weight": "bold", "size": "xl"},
             {"type": "text", "text": "（全部甜點需提前 3 天預訂）", "size": "sm", "color": "#666666"},
-            btn("達克瓦茲｜NT$95（2/4/6/8）", "PB:ITEM:dacquoise", enabled=not disable),
-            btn("原味司康｜NT$65", "PB:ITEM:scone", enabled=not disable),
-            btn("可麗露 6顆/盒｜NT$490", "PB:ITEM:canele6", enabled=not disable),
-            btn("伊思尼奶酥厚片｜NT$85", "PB:ITEM:toast", enabled=not disable),
+            *(_ITEM_BUTTONS_ORDERING if ordering else _ITEM_BUTTONS_BROWSING),
             {"type": "separator", "margin": "lg"},
             {"type": "button", "style": "secondary",
              "action": {"type": "postback", "label": "🧾 前往結帳", "data": "PB:CHECKOUT", "displayText": "前往結帳"}},
@@ -576,44 +1345,72 @@ def flex_pickup_method() -> dict:
     }
 
 
+# ✅ 固定不變的卡片：import 時組好並序列化一次，之後每次回覆直接重用（不要每點一次就重建/重新序列化整棵 dict）
+MSG_HOME_HINT = msg_flex_frozen("提示", flex_home_hint())
+MSG_MENU_VIEW_ONLY = msg_flex_frozen("甜點菜單", flex_menu_view_only())
+MSG_PRODUCT_MENU = msg_flex_frozen("甜點菜單", flex_product_menu(ordering=True))
+MSG_PICKUP_METHOD = msg_flex_frozen("取貨方式", flex_pickup_method())
+
+
+# ✅ 卡片裡固定不變的部分（按鈕列、標題）先序列化好，每次只組會變的文字
+_PHONE_CONFIRM_TITLE = frozen({"type": "text", "text": "電話二次確認", "weight": "bold", "size": "xl"})
+_PHONE_CONFIRM_HINT = frozen(
+    {"type": "text", "text": "請確認正確，避免通知不到你。", "size": "sm", "color": "#666666", "wrap": True}
+)
+
+
+@lru_cache(maxsize=None)
+def _phone_confirm_footer(kind: str) -> orjson.Fragment:
+    return frozen({"type": "box", "layout": "vertical", "spacing": "sm", "contents": [
+        {"type": "button", "style": "primary",
+         "action": {"type": "postback", "label": "✅ 正確", "data": f"PB:PHONE_OK:{kind}", "displayText": "電話正確"}},
+        {"type": "button", "style": "secondary",
+         "action": {"type": "postback", "label": "✏️ 重新輸入", "data": f"PB:PHONE_RETRY:{kind}", "displayText": "重新輸入電話"}},
+    ]})
+
+
 def flex_phone_confirm(phone: str, kind: str) -> dict:
-    ok_data = f"PB:PHONE_OK:{kind}"
-    retry_data = f"PB:PHONE_RETRY:{kind}"
     return {
         "type": "bubble",
         "body": {"type": "box", "layout": "vertical", "spacing": "md", "contents": [
-            {"type": "text", "text": "電話二次確認", "weight": "bold", "size": "xl"},
+            _PHONE_CONFIRM_TITLE,
             {"type": "text", "text": f"你填的電話：{phone}", "size": "md", "wrap": True},
-            {"type": "text", "text": "請確認正確，避免通知不到你。", "size": "sm", "color": "#666666", "wrap": True},
+            _PHONE_CONFIRM_HINT,
         ]},
-        "footer": {"type": "box", "layout": "vertical", "spacing": "sm", "contents": [
-            {"type": "button", "style": "primary",
-             "action": {"type": "postback", "label": "✅ 正確", "data": ok_data, "displayText": "電話正確"}},
-            {"type": "button", "style": "secondary",
-             "action": {"type": "postback", "label": "✏️ 重新輸入", "data": retry_data, "displayText": "重新輸入電話"}},
-        ]}
+        "footer": _phone_confirm_footer(kind),
     }
 
 
+_CHECKOUT_FOOTER = frozen({"type": "box", "layout": "vertical", "spacing": "sm", "contents": [
+    {"type": "button", "style": "primary",
+     "action": {"type": "postback", "label": "🛠 修改品項", "data": "PB:EDIT:MENU", "displayText": "修改品項"}},
+    {"type": "button", "style": "secondary",
+     "action": {"type": "postback", "label": "➕ 繼續加購", "data": "PB:CONTINUE", "displayText": "繼續加購"}},
+    {"type": "button", "style": "secondary",
+     "action": {"type": "postback", "label": "✅ 下一步", "data": "PB:NEXT", "displayText": "下一步"}},
+]})
+_CHECKOUT_TITLE = frozen({"type": "text", "text": "🧾 結帳內容", "weight": "bold", "size": "xl"})
+_CHECKOUT_SEPARATOR = frozen({"type": "separator", "margin": "md"})
+
+
 # ✅ 結帳卡：修正運費被擠成 NT$1...
-def flex_checkout_summary(sess: dict) -> dict:
-    cart = sess["cart"]
-    lines = [find_cart_line_label(x) for x in cart]
-    total = cart_total(cart)
+def flex_checkout_summary(sess: Session) -> dict:
+    lines = [find_cart_line_label(x) for x in sess.cart]
+    total = sess.cart_subtotal
 
-    method = sess.get("pickup_method") or "（未選）"
+    method = sess.pickup_method or "（未選）"
 
     # 日期/時段顯示
     if method == "宅配":
         fee = shipping_fee(total)
         grand = total + fee
-        date_show = sess.get("delivery_date") or "（未選）"
+        date_show = sess.delivery_date or "（未選）"
         time_show = "—"
     elif method == "店取":
         fee = 0
         grand = total
-        date_show = sess.get("pickup_date") or "（未選）"
-        time_show = sess.get("pickup_time") or "（未選）"
+        date_show = sess.pickup_date or "（未選）"
+        time_show = sess.pickup_time or "（未選）"
     else:
         fee = 0
         grand = total
@@ -650,32 +1447,38 @@ def flex_checkout_summary(sess: dict) -> dict:
         "type": "bubble",
         "size": "mega",
         "body": {"type": "box", "layout": "vertical", "spacing": "md", "contents": [
-            {"type": "text", "text": "🧾 結帳內容", "weight": "bold", "size": "xl"},
+            _CHECKOUT_TITLE,
             {"type": "text", "text": list_text, "wrap": True, "size": "sm"},
-            {"type": "separator", "margin": "md"},
+            _CHECKOUT_SEPARATOR,
             {"type": "text", "text": f"取貨方式：{method}", "size": "sm", "color": "#666666"},
             {"type": "text", "text": f"日期：{date_show}", "size": "sm", "color": "#666666"},
             {"type": "text", "text": f"時段：{time_show}", "size": "sm", "color": "#666666"},
-            {"type": "separator", "margin": "md"},
+            _CHECKOUT_SEPARATOR,
             totals_box,
         ]},
-        "footer": {"type": "box", "layout": "vertical", "spacing": "sm", "contents": [
-            {"type": "button", "style": "primary",
-             "action": {"type": "postback", "label": "🛠 修改品項", "data": "PB:EDIT:MENU", "displayText": "修改品項"}},
-            {"type": "button", "style": "secondary",
-             "action": {"type": "postback", "label": "➕ 繼續加購", "data": "PB:CONTINUE", "displayText": "繼續加購"}},
-            {"type": "button", "style": "secondary",
-             "action": {"type": "postback", "label": "✅ 下一步", "data": "PB:NEXT", "displayText": "下一步"}},
-        ]}
+        "footer": _CHECKOUT_FOOTER,
     }
 
 
+_ADMIN_SUMMARY_BUTTON = frozen({
+    "type": "button",
+    "style": "secondary",
+    "action": {"type": "postback", "label": "📋 今日待辦總覽", "data": "ADMIN:SUMMARY:TODAY", "displayText": "今日待辦"},
+})
+_ADMIN_RELOAD_BUTTON = frozen({
+    "type": "button",
+    "style": "secondary",
+    "action": {"type": "postback", "label": "🔄 重新讀取設定", "data": "ADMIN:RELOAD", "displayText": "重新讀取設定"},
+})
+
+
 def flex_admin_order_actions(order_id: str, method: str, current_status: str = "UNPAID") -> dict:
     """
     商家後台卡片（不噴 debug）
     1) 已收款
     2) 店取：已做好 / 宅配：已出貨
     3) 今日待辦總覽
+    4) 重新讀取設定（改完 settings 表馬上生效）
     """
     buttons = []
 
@@ -699,11 +1502,8 @@ def flex_admin_order_actions(order_id: str, method: str, current_status: str = "
             "action": {"type": "postback", "label": "🚚 已出貨，通知客人", "data": f"ADMIN:SHIPPED:{order_id}", "displayText": "已出貨"},
         })
 
-    buttons.append({
-        "type": "button",
-        "style": "secondary",
-        "action": {"type": "postback", "label": "📋 今日待辦總覽", "data": "ADMIN:SUMMARY:TODAY", "displayText": "今日待辦"},
-    })
+    buttons.append(_ADMIN_SUMMARY_BUTTON)
+    buttons.append(_ADMIN_RELOAD_BUTTON)
 
     return {
         "type": "bubble",
@@ -742,14 +1542,14 @@ def add_to_cart(user_id: str, item_key: str, flavor: Optional[str], qty: int):
     unit = meta["unit_price"]
     subtotal = unit * qty
 
-    sess["cart"].append({
-        "item_key": item_key,
-        "label": meta["label"],
-        "flavor": flavor or "",
-        "qty": qty,
-        "unit_price": unit,
-        "subtotal": subtotal,
-    })
+    sess.cart.append(CartItem(
+        item_key=item_key,
+        label=meta["label"],
+        flavor=flavor or "",
+        qty=qty,
+        unit_price=unit,
+        subtotal=subtotal,
+    ))
 
 
 def can_dec_item(item_key: str, new_qty: int) -> bool:
@@ -757,54 +1557,62 @@ def can_dec_item(item_key: str, new_qty: int) -> bool:
     return new_qty >= min_qty
 
 
-def build_cart_item_choices(sess: dict, mode: str) -> List[dict]:
+def build_cart_item_choices(sess: Session, mode: str) -> List[dict]:
     items = []
-    for idx, x in enumerate(sess["cart"]):
-        label = x["label"]
-        if x.get("flavor"):
-            label += f"（{x['flavor']}）"
-        label += f" ×{x['qty']}"
+    for idx, x in enumerate(sess.cart):
+        label = x.label
+        if x.flavor:
+            label += f"（{x.flavor}）"
+        label += f" ×{x.qty}"
         items.append(quick_postback(label, f"PB:EDIT:{mode}:{idx}", display_text=label))
     return items
 
 
 # ✅ 支援 step（達克瓦茲 2/4/6/8）
-def build_qty_quick(min_qty: int, max_qty: int, prefix: str, step: int = 1) -> List[dict]:
-    return [quick_postback(str(i), f"{prefix}{i}", display_text=str(i)) for i in range(min_qty, max_qty + 1, step)]
+@lru_cache(maxsize=32)
+def build_qty_quick(min_qty: int, max_qty: int, prefix: str, step: int = 1) -> Tuple[dict, ...]:
+    # 組合只有幾種（看 ITEMS 的 min/max/step），建一次重複用；回傳 tuple，呼叫端不要改內容
+    return tuple(quick_postback(str(i), f"{prefix}{i}", display_text=str(i)) for i in range(min_qty, max_qty + 1, step))
 
 
 # =========================
 # Order write: A/B/C + cashflow
 # =========================
-def write_order_A(user_id: str, order_id: str, sess: dict) -> bool:
-    cart = sess["cart"]
-    total = cart_total(cart)
+def cart_raw_json(cart: List[CartItem]) -> str:
+    # A表 E 欄格式不變：{"cart":[{item_key,label,flavor,qty,unit_price,subtotal}]}
+    # orjson 直接序列化 slots dataclass（欄位順序同原本的 dict），不用先轉 dict
+    return orjson.dumps({"cart": cart}).decode("utf-8")
+
 
-    pickup_method = sess.get("pickup_method") or ""
-    pickup_date = sess.get("pickup_date") or ""
-    pickup_time = sess.get("pickup_time") or ""
+def write_order_A(user_id: str, order_id: str, sess: Session, created_at: str) -> bool:
+    cart = sess.cart
+    total = sess.cart_subtotal
+
+    pickup_method = sess.pickup_method or ""
+    pickup_date = sess.pickup_date or ""
+    pickup_time = sess.pickup_time or ""
 
     note = ""
     if pickup_method == "宅配":
-        delivery_date = sess.get("delivery_date") or ""
-        dn = sess.get("delivery_name") or ""
-        dp = sess.get("delivery_phone") or ""
-        da = sess.get("delivery_address") or ""
+        delivery_date = sess.delivery_date or ""
+        dn = sess.delivery_name or ""
+        dp = sess.delivery_phone or ""
+        da = sess.delivery_address or ""
         note = f"期望到貨:{delivery_date} | 收件人:{dn} | 電話:{dp} | 地址:{da}"
         pickup_date = delivery_date
         pickup_time = ""
 
     if pickup_method == "店取":
-        pn = sess.get("pickup_name") or ""
-        pp = sess.get("pickup_phone") or ""
+        pn = sess.pickup_name or ""
+        pp = sess.pickup_phone or ""
         note = f"取件人:{pn} | 電話:{pp}"
 
     rowA = [
-        now_str(),                               # A created_at
+        created_at,                              # A created_at
         user_id,                                 # B user_id
-        "",                                      # C display_name（先留空）
+        cached_display_name(user_id),            # C display_name（快取沒有就先留空）
         order_id,                                # D order_id
-        json.dumps({"cart": cart}, ensure_ascii=False),  # E raw_json
+        cart_raw_json(cart),                     # E raw_json
         pickup_method,                           # F method
         pickup_date,                             # G pickup_date
         pickup_time,                             # H pickup_time
@@ -813,10 +1621,10 @@ def write_order_A(user_id: str, order_id: str, sess: dict) -> bool:
         "UNPAID",                                # K status（最新狀態）
         cart_readable_text(cart),                # L transaction_note（白話）
     ]
-    return sheet_append(SHEET_A_NAME, rowA)
+    return sheet_enqueue(SHEET_A_NAME, rowA)
 
 
-def write_order_B(order_id: str, sess: dict) -> bool:
+def write_order_B(order_id: str, sess: Session, created_at: str) -> bool:
     """
     B表：12欄
     A created_at
@@ -832,135 +1640,177 @@ def write_order_B(order_id: str, sess: dict) -> bool:
     K pickup_time
     L phone
     """
-    ok_all = True
-    created_at = now_str()
-    pickup_method = sess.get("pickup_method") or ""
-    pickup_date = sess.get("pickup_date") or ""
-    pickup_time = sess.get("pickup_time") or ""
+    pickup_method = sess.pickup_method or ""
+    pickup_date = sess.pickup_date or ""
+    pickup_time = sess.pickup_time or ""
 
     if pickup_method == "宅配":
-        pickup_date = sess.get("delivery_date") or ""
+        pickup_date = sess.delivery_date or ""
         pickup_time = ""
 
-    phone = sess.get("pickup_phone") if pickup_method == "店取" else sess.get("delivery_phone")
+    phone = sess.pickup_phone if pickup_method == "店取" else sess.delivery_phone
 
-    for it in sess["cart"]:
-        item_name = it["label"]
-        flavor = (it.get("flavor") or "").strip()
-        spec = ""
+    phone = phone or ""
+    spec = ""
 
-        rowB = [
+    # 整張購物車的列一次排進佇列
+    rows = [
+        [
             created_at,
             order_id,
-            item_name,
+            it.label,
             spec,
-            flavor,
-            it["qty"],
-            it["unit_price"],
-            it["subtotal"],
+            it.flavor,
+            it.qty,
+            it.unit_price,
+            it.subtotal,
             pickup_method,
             pickup_date,
             pickup_time,
-            phone or "",
+            phone,
         ]
-        ok = sheet_append(SHEET_B_NAME, rowB)
-        ok_all = ok_all and ok
-
-    return ok_all
+        for it in sess.cart
+    ]
+    return sheet_enqueue_rows(SHEET_B_NAME, rows)
 
 
-def write_order_C_order(order_id: str, sess: dict) -> bool:
+def write_order_C_order(order_id: str, sess: Session, created_at: str) -> bool:
     """
     C表 = c_log：ORDER 事件（下單時 1 筆）
     欄位：
     created_at, order_id, flow_type, method, amount, shipping_fee, grand_total, status, note
     """
-    created_at = now_str()
-    method = sess.get("pickup_method") or ""
-    amount = cart_total(sess["cart"])
+    method = sess.pickup_method or ""
+    amount = sess.cart_subtotal
     fee = shipping_fee(amount) if method == "宅配" else 0
     grand = amount + fee
 
     if method == "店取":
-        note = f"店取 {sess.get('pickup_date','')} {sess.get('pickup_time','')} | {sess.get('pickup_name','')} | {sess.get('pickup_phone','')}"
+        note = f"店取 {sess.pickup_date} {sess.pickup_time} | {sess.pickup_name} | {sess.pickup_phone}"
     else:
-        note = f"宅配 期望到貨:{sess.get('delivery_date','')} | {sess.get('delivery_name','')} | {sess.get('delivery_phone','')} | {sess.get('delivery_address','')}"
+        note = f"宅配 期望到貨:{sess.delivery_date} | {sess.delivery_name} | {sess.delivery_phone} | {sess.delivery_address}"
 
     row = [created_at, order_id, "ORDER", method, amount, fee, grand, "ORDER", note]
-    return sheet_append(SHEET_C_NAME, row)
+    return sheet_enqueue(SHEET_C_NAME, row)
 
 
 # ✅ cashflow：下單也寫 1 筆（同格式）
-def write_order_cashflow_order(order_id: str, sess: dict) -> bool:
+def write_order_cashflow_order(order_id: str, sess: Session, created_at: str) -> bool:
     """
     cashflow 表：ORDER 事件（下單時 1 筆）
     欄位：
     created_at, order_id, flow_type, method, amount, shipping_fee, grand_total, status, note
     """
-    created_at = now_str()
-    method = sess.get("pickup_method") or ""
-    amount = cart_total(sess["cart"])
+    method = sess.pickup_method or ""
+    amount = sess.cart_subtotal
     fee = shipping_fee(amount) if method == "宅配" else 0
     grand = amount + fee
 
     if method == "店取":
-        note = f"店取 {sess.get('pickup_date','')} {sess.get('pickup_time','')} | {sess.get('pickup_name','')} | {sess.get('pickup_phone','')}"
+        note = f"店取 {sess.pickup_date} {sess.pickup_time} | {sess.pickup_name} | {sess.pickup_phone}"
     else:
-        note = f"宅配 期望到貨:{sess.get('delivery_date','')} | {sess.get('delivery_name','')} | {sess.get('delivery_phone','')} | {sess.get('delivery_address','')}"
+        note = f"宅配 期望到貨:{sess.delivery_date} | {sess.delivery_name} | {sess.delivery_phone} | {sess.delivery_address}"
 
     row = [created_at, order_id, "ORDER", method, amount, fee, grand, "ORDER", note]
-    return sheet_append(SHEET_CASHFLOW_NAME, row)
+    return sheet_enqueue(SHEET_CASHFLOW_NAME, row)
 
 
 def append_C_status(order_id: str, status: str, note: str) -> bool:
     row = [now_str(), order_id, "STATUS", "", "", "", "", status, note]
-    ok1 = sheet_append(SHEET_C_NAME, row)
-    ok2 = sheet_append(SHEET_CASHFLOW_NAME, row)  # ✅ 狀態也同步寫到 cashflow（你可不需要，但通常很實用）
+    ok1 = sheet_enqueue(SHEET_C_NAME, row)
+    ok2 = sheet_enqueue(SHEET_CASHFLOW_NAME, row)  # ✅ 狀態也同步寫到 cashflow（你可不需要，但通常很實用）
     return bool(ok1 and ok2)
 
 
+# ✅ order_id → A表列號 的索引：第一次（或找不到時）只讀 D 欄建起來，
+# 之後查狀態/改狀態只讀那一列，不用每次把整張 A:L 拉回來掃
+_ORDER_ROW_INDEX: Dict[str, int] = {}
+_ORDER_ROW_LOCK = threading.Lock()
+
+
+def rebuild_order_row_index():
+    # 不寫結束列：Sheets 只回有資料的列（不會因為固定上限漏掉後面的訂單）
+    col = sheet_read_range(SHEET_A_NAME, "D2:D")
+    index: Dict[str, int] = {}
+    for i, r in enumerate(col, start=2):
+        oid = (r[0] or "").strip() if r else ""
+        if oid:
+            index.setdefault(oid, i)  # 重複的 order_id 跟以前一樣以最上面那筆為準
+    with _ORDER_ROW_LOCK:
+        _ORDER_ROW_INDEX.clear()
+        _ORDER_ROW_INDEX.update(index)
+
+
+def read_order_row(order_id: str, a1_cols: Tuple[str, str]) -> Tuple[Optional[int], List[str]]:
+    """
+    讀 A表該訂單那一列的 a1_cols 欄（要包含 D 欄，用來確認列號沒跑掉）
+    回傳 (row_idx, 欄位值)；有人在表上插/刪/排序過列 → 索引重建一次再讀
+    """
+    first_col, last_col = a1_cols
+    d_pos = ord("D") - ord(first_col)
+
+    def read_at(row_idx: int) -> Optional[List[str]]:
+        rows = sheet_read_range(SHEET_A_NAME, f"{first_col}{row_idx}:{last_col}{row_idx}")
+        vals = rows[0] if rows else []
+        if len(vals) > d_pos and (vals[d_pos] or "").strip() == order_id:
+            return vals
+        return None
+
+    row_idx = _ORDER_ROW_INDEX.get(order_id)
+    if row_idx is not None:
+        vals = read_at(row_idx)
+        if vals is not None:
+            return row_idx, vals
+
+    # 索引裡沒有（新訂單）或列號已經對不上 → 重建一次
+    rebuild_order_row_index()
+    row_idx = _ORDER_ROW_INDEX.get(order_id)
+    if row_idx is None:
+        return None, []
+    vals = read_at(row_idx)
+    if vals is None:
+        return None, []
+    return row_idx, vals
+
+
 def find_user_id_by_order_id(order_id: str) -> Optional[str]:
     # A表：order_id 在 D；user_id 在 B
-    rows = sheet_read_range(SHEET_A_NAME, "A1:L5000")
-    if not rows or len(rows) < 2:
+    row_idx, vals = read_order_row(order_id, ("B", "D"))
+    if not row_idx:
         return None
-    for r in rows[1:]:
-        if len(r) >= 4 and (r[3] or "").strip() == order_id:
-            return (r[1] or "").strip()
-    return None
+    return (vals[0] or "").strip()
 
 
 def get_A_row_index_by_order_id(order_id: str) -> Optional[int]:
     """
     回傳 A表中（1-based row index）訂單所在列
     """
-    rows = sheet_read_range(SHEET_A_NAME, "A1:D5000")
-    if not rows or len(rows) < 2:
-        return None
-    for i, r in enumerate(rows[1:], start=2):
-        if len(r) >= 4 and (r[3] or "").strip() == order_id:
-            return i
-    return None
+    row_idx, _ = read_order_row(order_id, ("D", "D"))
+    return row_idx
 
 
-def get_A_status_by_order_id(order_id: str) -> Optional[str]:
+def read_A_status_row(order_id: str) -> Tuple[Optional[int], Optional[str], str]:
     """
-    讀取 A表 K 欄（status）
+    一次讀 A表那一列的 B～K：回傳 (列號, K 欄 status, B 欄 user_id)
+    改狀態時直接寫這一列、通知客人也不用再查一次
     """
-    row_idx = get_A_row_index_by_order_id(order_id)
+    row_idx, vals = read_order_row(order_id, ("B", "K"))
     if not row_idx:
-        return None
-    rows = sheet_read_range(SHEET_A_NAME, f"K{row_idx}:K{row_idx}")
-    if rows and rows[0]:
-        return (rows[0][0] or "").strip()
-    return ""
+        return None, None, ""
+    status = (vals[9] or "").strip() if len(vals) > 9 else ""
+    return row_idx, status, (vals[0] or "").strip()
 
 
-def update_A_table_status(order_id: str, new_status: str) -> bool:
+def get_A_status_by_order_id(order_id: str) -> Optional[str]:
+    return read_A_status_row(order_id)[1]
+
+
+def update_A_table_status(order_id: str, new_status: str, row_idx: Optional[int] = None) -> bool:
     """
-    A表：更新 K 欄 status（最新狀態）
+    A表：更新 K 欄 status（最新狀態）；row_idx 已知（剛讀過狀態）就直接寫
     """
-    row_idx = get_A_row_index_by_order_id(order_id)
+    if row_idx is None:
+        row_idx = get_A_row_index_by_order_id(order_id)
     if not row_idx:
         return False
     return sheet_update_a1(SHEET_A_NAME, f"K{row_idx}", [[new_status]])
@@ -977,41 +1827,59 @@ def update_order_status(
     admin_message: str,
     customer_message: Optional[str] = None,
 ):
-    current = get_A_status_by_order_id(order_id) or ""
+    row_idx, current, target_user = read_A_status_row(order_id)
+    if row_idx is None:
+        # A表還沒有這一列（剛建單、或 Sheets 掛掉還在重送）：不寫 c_log、不通知客人，免得紀錄跟 K 欄對不上
+        if order_row_pending(order_id):
+            line_reply(reply_token, [msg_text("這筆訂單還在寫入表單中，請過幾秒再按一次 🙏")])
+        else:
+            line_reply(reply_token, [msg_text(f"表單裡找不到訂單 {order_id}，麻煩你看一下 Google Sheet。")])
+        return
+
+    current = current or ""
     if current.strip().upper() == new_status.strip().upper():
         line_reply(reply_token, [msg_text("這筆訂單已經更新過囉～不用重複按 ✅")])
         return
 
-    okA = update_A_table_status(order_id, new_status)
-    okC = append_C_status(order_id, new_status, admin_message)
+    # A表 K 欄是當場寫：沒寫成功就停在這裡（c_log 不記、客人不通知），管理員再按一次即可
+    if not update_A_table_status(order_id, new_status, row_idx):
+        line_reply(reply_token, [msg_text("我有幫你按，但表單寫入好像沒成功，麻煩你看一下 Google Sheet 欄位/權限。")])
+        return
 
-    if okA and okC:
+    # c_log/cashflow 走寫入佇列，送不進去時 flusher 會另外推播
+    if append_C_status(order_id, new_status, admin_message):
         line_reply(reply_token, [msg_text(admin_message)])
     else:
-        line_reply(reply_token, [msg_text("我有幫你按，但表單寫入好像沒成功，麻煩你看一下 Google Sheet 欄位/權限。")])
+        line_reply(reply_token, [msg_text("狀態已更新，但 c_log/cashflow 沒排進寫入佇列，麻煩你看一下 Google Sheet 設定。")])
 
     if customer_message:
+        # push 在背景做，管理員先拿到回覆；user_id 剛剛讀狀態時已經一起拿到了
+        run_in_background(notify_customer, order_id, customer_message, target_user)
+
+
+def notify_customer(order_id: str, customer_message: str, target_user: Optional[str] = None):
+    if not target_user:
         target_user = find_user_id_by_order_id(order_id)
-        if target_user:
-            line_push(target_user, [msg_text(customer_message)])
+    if target_user:
+        line_push(target_user, [msg_text(customer_message)])
 
 
 # =========================
 # 今日待辦總覽（商家用）
 # =========================
 def build_today_summary_text() -> str:
-    rows = sheet_read_range(SHEET_A_NAME, "A1:K5000")
-    if not rows or len(rows) < 2:
+    # 只用得到 A created_at 跟 K status：一次 batchGet 讀這兩欄，不用把 A～K 整塊拉回來
+    cols = sheet_read_columns(SHEET_A_NAME, ("A2:A", "K2:K"))
+    if len(cols) < 2 or not cols[0]:
         return "今天還沒有訂單～"
+    created_col, status_col = cols
 
-    today = datetime.now(TZ).strftime("%Y-%m-%d")
+    today = fmt_ymd(today_tw())
     unp, paid, ready, shipped = 0, 0, 0, 0
 
-    for r in rows[1:]:
-        if len(r) < 11:
-            continue
-        created_at = (r[0] or "").strip()
-        status = (r[10] or "").strip().upper()
+    for created_at, status in zip(created_col, status_col):
+        created_at = (created_at or "").strip()
+        status = (status or "").strip().upper()
         if not created_at.startswith(today):
             continue
         if status == "UNPAID":
@@ -1036,12 +1904,22 @@ def build_today_summary_text() -> str:
 # =========================
 # Signature verify
 # =========================
+# key 的 ipad/opad 只算一次；每個 webhook 從這個模板 copy() 再餵 body
+_SIGNATURE_HMAC = hmac.new(CHANNEL_SECRET_BYTES, digestmod=hashlib.sha256) if CHANNEL_SECRET_BYTES else None
+
+
 def verify_line_signature(body: bytes, signature: str) -> bool:
-    if not CHANNEL_SECRET:
+    if _SIGNATURE_HMAC is None:
         return False
-    mac = hmac.new(CHANNEL_SECRET.encode("utf-8"), body, hashlib.sha256).digest()
-    expected = base64.b64encode(mac).decode("utf-8")
-    return hmac.compare_digest(expected, signature)
+    try:
+        provided = base64.b64decode(signature, validate=True)
+    except Exception:
+        return False
+    # 直接比 32 bytes 的 digest，不用再把算出來的 digest 轉回 base64 字串
+    mac = _SIGNATURE_HMAC.copy()
+    mac.update(body)
+    expected = mac.digest()
+    return hmac.compare_digest(expected, provided)
 
 
 # =========================
@@ -1064,22 +1942,111 @@ def health_head():
     return PlainTextResponse("", status_code=200)
 
 
+# =========================
+# Event queue（fast ACK）
+# =========================
+# /callback 驗完簽章就把事件丟進佇列、馬上回 200 給 LINE；
+# 真正的處理（回覆、寫表）交給背景 worker。
+# 同一個 user 的事件固定進同一條佇列，確保順序不亂。
+# 佇列有上限：爆量時 /callback 會在 put 等位置（背壓），不會無限吃記憶體
+EVENT_QUEUE_MAX = max(1, safe_int_env("EVENT_QUEUE_MAX", 1000))
+EVENT_QUEUES: List[asyncio.Queue] = []
+_EVENT_WORKER_TASKS: List[asyncio.Task] = []
+
+
+def event_queue_for(ev: dict) -> asyncio.Queue:
+    user_id = (ev.get("source") or {}).get("userId", "")
+    return EVENT_QUEUES[hash(user_id) % len(EVENT_QUEUES)]
+
+
+async def event_worker(q: asyncio.Queue):
+    while True:
+        ev = await q.get()
+        try:
+            await asyncio.to_thread(handle_event, ev)
+        except Exception:
+            logger.exception("handle_event failed")
+        finally:
+            q.task_done()
+
+
+@app.on_event("startup")
+async def start_background_workers():
+    open_order_wal()
+    threading.Thread(target=_sheet_flush_loop, name="sheet-flusher", daemon=True).start()
+    threading.Thread(target=_session_gc_loop, name="session-gc", daemon=True).start()
+    if GSHEET_ID:
+        threading.Thread(target=_sheets_token_refresh_loop, name="sheets-token", daemon=True).start()
+    for _ in range(EVENT_WORKERS):
+        q = asyncio.Queue(maxsize=EVENT_QUEUE_MAX)
+        EVENT_QUEUES.append(q)
+        _EVENT_WORKER_TASKS.append(asyncio.create_task(event_worker(q)))
+
+
+@app.on_event("shutdown")
+async def stop_background_workers():
+    # 先把還沒處理的事件做完，再把待寫入的列送出
+    try:
+        await asyncio.wait_for(asyncio.gather(*(q.join() for q in EVENT_QUEUES)), timeout=10)
+    except asyncio.TimeoutError:
+        logger.warning("event queue not drained before shutdown")
+    for t in _EVENT_WORKER_TASKS:
+        t.cancel()
+    await asyncio.to_thread(PUSH_POOL.shutdown, wait=True)
+    await asyncio.to_thread(flush_pending_rows)  # flusher 正在送的話會等它送完（_FLUSH_LOCK）再送剩下的
+
+
+# LINE Console「Verify」送來的假事件：replyToken 全 0 / 全 f、userId 是 Udeadbeef...
+_VERIFY_REPLY_TOKENS = frozenset({"0" * 32, "f" * 32})
+
+
+def is_verify_event(ev: dict) -> bool:
+    if ev.get("replyToken") in _VERIFY_REPLY_TOKENS:
+        return True
+    uid = (ev.get("source") or {}).get("userId") or ""
+    return uid.startswith("Udeadbeef")
+
+
+# ✅ LINE 重送（deliveryContext.isRedelivery）會帶同一個 webhookEventId：處理過就跳過，避免重複下單/重複回覆
+# 只有 /callback（event loop 單執行緒）會碰，不用鎖
+_SEEN_EVENT_IDS: TTLCache = TTLCache(maxsize=10000, ttl=600)
+
+
+def is_duplicate_event(ev: dict) -> bool:
+    event_id = ev.get("webhookEventId")
+    if not event_id:
+        return False
+    if event_id in _SEEN_EVENT_IDS:
+        return True
+    _SEEN_EVENT_IDS[event_id] = True
+    return False
+
+
 @app.post("/callback")
 async def callback(request: Request):
-    body = await request.body()
     signature = request.headers.get("X-Line-Signature", "")
+    if not signature:
+        # 沒帶簽章（掃描器/亂打的請求）：body 都不用讀就擋掉
+        raise HTTPException(status_code=400, detail="Invalid signature")
 
+    body = await request.body()
     if not verify_line_signature(body, signature):
         raise HTTPException(status_code=400, detail="Invalid signature")
 
-    payload = json.loads(body.decode("utf-8"))
+    payload = orjson.loads(body)  # bytes 直接 parse，不用先 decode 成 str
     events = payload.get("events", [])
 
     for ev in events:
+        if is_verify_event(ev) or is_duplicate_event(ev):
+            continue
+        if EVENT_QUEUES:
+            await event_queue_for(ev).put(ev)
+            continue
+        # worker 還沒啟動（例如直接呼叫 app 沒跑 startup）就照舊同步處理
         try:
             handle_event(ev)
-        except Exception as e:
-            print("[ERROR] handle_event:", e)
+        except Exception:
+            logger.exception("handle_event failed")
 
     return PlainTextResponse("OK")
 
@@ -1087,571 +2054,611 @@ async def callback(request: Request):
 # =========================
 # Event handler
 # =========================
-def handle_event(ev: dict):
-    etype = ev.get("type")
-    user_id = (ev.get("source") or {}).get("userId", "")
-    reply_token = ev.get("replyToken", "")
-
-    if not user_id:
+def on_message_event(ev: dict, user_id: str, reply_token: str):
+    message = ev.get("message") or {}
+    if message.get("type") != "text":
         return
 
+    text = (message.get("text") or "").strip()
     sess = get_session(user_id)
 
-    # ---- message text ----
-    if etype == "message" and (ev.get("message") or {}).get("type") == "text":
-        text = (ev["message"].get("text") or "").strip()
+    if text == "甜點":
+        line_reply(reply_token, [MSG_MENU_VIEW_ONLY])
+        return
 
-        if text == "甜點":
-            line_reply(reply_token, [msg_flex("甜點菜單", flex_menu_view_only())])
-            return
+    if text == "我要下單":
+        sess.ordering = True
+        sess.state = "IDLE"
+        prefetch_display_name(user_id)
+        line_reply(reply_token, [
+            msg_text("好的～開始下單。\n請從菜單選擇商品加入購物車。"),
+            MSG_PRODUCT_MENU,
+        ])
+        return
 
-        if text == "我要下單":
-            sess["ordering"] = True
-            sess["state"] = "IDLE"
-            line_reply(reply_token, [
-                msg_text("好的～開始下單。\n請從菜單選擇商品加入購物車。"),
-                msg_flex("甜點菜單", flex_product_menu(ordering=True)),
-            ])
-            return
+    if text in ["清空重來", "清空", "reset"]:
+        reset_session(sess)
+        line_reply(reply_token, [msg_text("已清空～\n請點「我要下單」開始，或點「甜點」先看菜單。")])
+        return
 
-        if text in ["清空重來", "清空", "reset"]:
-            reset_session(sess)
-            line_reply(reply_token, [msg_text("已清空～\n請點「我要下單」開始，或點「甜點」先看菜單。")])
-            return
+    if text == "取貨說明":
+        line_reply(reply_token, [msg_text(PICKUP_NOTICE + "\n\n" + DELIVERY_NOTICE)])
+        return
 
-        if text == "取貨說明":
-            line_reply(reply_token, [msg_text(PICKUP_NOTICE + "\n\n" + DELIVERY_NOTICE)])
-            return
+    if text == "付款說明":
+        line_reply(reply_token, [msg_text(BANK_TRANSFER_TEXT)])
+        return
 
-        if text == "付款說明":
-            line_reply(reply_token, [msg_text(BANK_TRANSFER_TEXT)])
-            return
+    if text.startswith("已轉帳"):
+        line_reply(reply_token, [msg_text("收到～我們會核對帳款後安排出貨/取貨。\n若需補充資訊也可以直接留言。")])
+        return
 
-        if text.startswith("已轉帳"):
-            line_reply(reply_token, [msg_text("收到～我們會核對帳款後安排出貨/取貨。\n若需補充資訊也可以直接留言。")])
-            return
+    handle_state_text(user_id, reply_token, text)
 
-        handle_state_text(user_id, reply_token, text)
-        return
 
-    # ---- postback ----
-    if etype == "postback":
-        data = (ev.get("postback") or {}).get("data", "")
-        handle_postback(user_id, reply_token, data)
-        return
+def on_postback_event(ev: dict, user_id: str, reply_token: str):
+    data = (ev.get("postback") or {}).get("data", "")
+    handle_postback(user_id, reply_token, data)
 
 
-def reset_session(sess: dict):
-    sess["ordering"] = False
-    sess["state"] = "IDLE"
-    sess["cart"] = []
-    sess["pending_item"] = None
-    sess["pending_flavor"] = None
+# 事件類型 -> handler（一次 dict 查表，不用一路 if/elif 比下去）
+EVENT_HANDLERS = {
+    "message": on_message_event,
+    "postback": on_postback_event,
+}
 
-    sess["pickup_method"] = None
-    sess["pickup_date"] = None
-    sess["pickup_time"] = None
-    sess["pickup_name"] = None
-    sess["pickup_phone"] = None
-    sess["pickup_phone_ok"] = False
 
-    sess["delivery_date"] = None
-    sess["delivery_name"] = None
-    sess["delivery_phone"] = None
-    sess["delivery_phone_ok"] = False
-    sess["delivery_address"] = None
+def handle_event(ev: dict):
+    handler = EVENT_HANDLERS.get(ev.get("type"))
+    if not handler:
+        return
+
+    user_id = (ev.get("source") or {}).get("userId", "")
+    reply_token = ev.get("replyToken", "")
+    if not user_id:
+        return
 
-    sess["edit_mode"] = None
-    sess["last_postback_data"] = None
-    sess["last_postback_ts"] = 0.0
+    handler(ev, user_id, reply_token)
 
 
-def too_fast_duplicate(sess: dict, data: str) -> bool:
-    now_ts = datetime.now(TZ).timestamp()
-    if sess.get("last_postback_data") == data and (now_ts - float(sess.get("last_postback_ts", 0.0))) < 1.0:
+def reset_session(sess: Session):
+    # 原地重跑 dataclass 的 __init__：所有欄位一次回到預設值（cart 會是新的 list），
+    # 拿著同一個 sess 的呼叫端不受影響
+    Session.__init__(sess)
+
+
+def too_fast_duplicate(sess: Session, data: str) -> bool:
+    now_ts = time.monotonic()  # 只比間隔，不用時區/牆上時間
+    if sess.last_postback_data == data and (now_ts - sess.last_postback_ts) < 1.0:
         return True
-    sess["last_postback_data"] = data
-    sess["last_postback_ts"] = now_ts
+    sess.last_postback_data = data
+    sess.last_postback_ts = now_ts
     return False
 
 
+def parse_postback(data: str) -> Tuple[str, str]:
+    """
+    一次切開 postback data："PB:ITEM:scone" -> ("PB:ITEM", "scone")；"PB:NEXT" -> ("PB:NEXT", "")
+    """
+    head, _, rest = data.partition(":")
+    action, _, arg = rest.partition(":")
+    return f"{head}:{action}", arg.strip()
+
+
 # =========================
 # Postback flows
 # =========================
-def handle_postback(user_id: str, reply_token: str, data: str):
-    sess = get_session(user_id)
+# 每個 postback 一個 handler：h_xxx(user_id, reply_token, sess, arg)
+def reply_flow_mismatch(reply_token: str):
+    line_reply(reply_token, [msg_text("我有收到你的操作～但流程沒對上。\n要下單請點「我要下單」。")])
 
-    if too_fast_duplicate(sess, data):
+
+def handle_admin_postback(user_id: str, reply_token: str, data: str):
+    if ADMIN_USER_IDS and user_id not in ADMIN_USER_IDS:
+        line_reply(reply_token, [msg_text("此功能僅限商家管理員使用～")])
         return
 
-    # ---- 管理員功能 ----
-    if data.startswith("ADMIN:"):
-        if ADMIN_USER_IDS and user_id not in ADMIN_USER_IDS:
-            line_reply(reply_token, [msg_text("此功能僅限商家管理員使用～")])
-            return
+    parts = data.split(":")
+    if len(parts) < 2:
+        line_reply(reply_token, [msg_text("指令格式錯誤～")])
+        return
 
-        parts = data.split(":")
-        if len(parts) < 2:
-            line_reply(reply_token, [msg_text("指令格式錯誤～")])
-            return
+    act = parts[1].strip()
 
-        act = parts[1].strip()
+    if act == "SUMMARY":
+        line_reply(reply_token, [msg_text(build_today_summary_text())])
+        return
 
-        if act == "SUMMARY":
-            line_reply(reply_token, [msg_text(build_today_summary_text())])
-            return
+    if act == "RELOAD":
+        invalidate_settings()
+        settings = load_settings()
+        line_reply(reply_token, [msg_text(
+            "✅ 已重新讀取 settings\n"
+            f"公休星期：{','.join(str(x) for x in sorted(settings['closed_weekdays'])) or '無'}\n"
+            f"公休日期：{len(settings['closed_dates'])} 天\n"
+            f"可選：{settings['min_days']}～{settings['max_days']} 天後"
+        )])
+        return
 
-        if len(parts) != 3:
-            line_reply(reply_token, [msg_text("指令格式錯誤～")])
-            return
+    if len(parts) != 3:
+        line_reply(reply_token, [msg_text("指令格式錯誤～")])
+        return
 
-        order_id = parts[2].strip()
-
-        if act == "PAID":
-            update_order_status(
-                reply_token=reply_token,
-                admin_user_id=user_id,
-                order_id=order_id,
-                new_status="PAID",
-                admin_message="💰 收款完成，開始製作囉",
-                customer_message=f"💰 已收到款項，我們會開始製作。\n訂單編號：{order_id}",
-            )
-            return
+    order_id = parts[2].strip()
+
+    if act == "PAID":
+        update_order_status(
+            reply_token=reply_token,
+            admin_user_id=user_id,
+            order_id=order_id,
+            new_status="PAID",
+            admin_message="💰 收款完成，開始製作囉",
+            customer_message=f"💰 已收到款項，我們會開始製作。\n訂單編號：{order_id}",
+        )
+        return
 
-        if act == "READY":
-            update_order_status(
-                reply_token=reply_token,
-                admin_user_id=user_id,
-                order_id=order_id,
-                new_status="READY",
-                admin_message="📣 已做好，已通知客人取貨",
-                customer_message=f"📣 你的甜點已完成，可以來取貨囉！\n訂單編號：{order_id}\n如需更改取貨時間請回覆訊息。",
-            )
-            return
+    if act == "READY":
+        update_order_status(
+            reply_token=reply_token,
+            admin_user_id=user_id,
+            order_id=order_id,
+            new_status="READY",
+            admin_message="📣 已做好，已通知客人取貨",
+            customer_message=f"📣 你的甜點已完成，可以來取貨囉！\n訂單編號：{order_id}\n如需更改取貨時間請回覆訊息。",
+        )
+        return
+
+    if act == "SHIPPED":
+        update_order_status(
+            reply_token=reply_token,
+            admin_user_id=user_id,
+            order_id=order_id,
+            new_status="SHIPPED",
+            admin_message="🚚 已出貨，已通知客人",
+            customer_message=f"🚚 你的訂單已出貨。\n訂單編號：{order_id}\n提醒：運送可能因天候/物流量延遲。",
+        )
+        return
+
+    line_reply(reply_token, [msg_text("我看不懂這個按鈕耶～")])
 
-        if act == "SHIPPED":
-            update_order_status(
-                reply_token=reply_token,
-                admin_user_id=user_id,
-                order_id=order_id,
-                new_status="SHIPPED",
-                admin_message="🚚 已出貨，已通知客人",
-                customer_message=f"🚚 你的訂單已出貨。\n訂單編號：{order_id}\n提醒：運送可能因天候/物流量延遲。",
-            )
-            return
 
-        line_reply(reply_token, [msg_text("我看不懂這個按鈕耶～")])
+def h_reset(user_id: str, reply_token: str, sess: Session, arg: str):
+    reset_session(sess)
+    line_reply(reply_token, [msg_text("已清空～\n請點「我要下單」開始，或點「甜點」先看菜單。")])
+
+
+def h_continue(user_id: str, reply_token: str, sess: Session, arg: str):
+    if not sess.ordering:
+        line_reply(reply_token, [msg_text("請先點「我要下單」開始下單流程～")])
         return
+    line_reply(reply_token, [MSG_PRODUCT_MENU])
 
-    # RESET
-    if data == "PB:RESET":
-        reset_session(sess)
-        line_reply(reply_token, [msg_text("已清空～\n請點「我要下單」開始，或點「甜點」先看菜單。")])
+
+def h_checkout(user_id: str, reply_token: str, sess: Session, arg: str):
+    if not sess.ordering:
+        line_reply(reply_token, [msg_text("請先點「我要下單」開始下單流程～")])
+        return
+    if not sess.cart:
+        line_reply(reply_token, [msg_text("購物車是空的～先選商品喔"), MSG_PRODUCT_MENU])
         return
 
-    # CONTINUE
-    if data == "PB:CONTINUE":
-        if not sess["ordering"]:
-            line_reply(reply_token, [msg_text("請先點「我要下單」開始下單流程～")])
-            return
-        line_reply(reply_token, [msg_flex("甜點菜單", flex_product_menu(ordering=True))])
+    sess.state = "WAIT_PICKUP_METHOD"
+    prefetch_display_name(user_id)  # 快取可能在逛很久之後過期了
+    line_reply(reply_token, [MSG_PICKUP_METHOD])
+
+
+def h_item(user_id: str, reply_token: str, sess: Session, arg: str):
+    if not sess.ordering:
+        line_reply(reply_token, [msg_text("想下單請先點「我要下單」～\n你也可以點「甜點」先看菜單。")])
         return
 
-    # CHECKOUT entry
-    if data == "PB:CHECKOUT":
-        if not sess["ordering"]:
-            line_reply(reply_token, [msg_text("請先點「我要下單」開始下單流程～")])
-            return
-        if not sess["cart"]:
-            line_reply(reply_token, [msg_text("購物車是空的～先選商品喔"), msg_flex("甜點菜單", flex_product_menu(ordering=True))])
-            return
+    item_key = arg
+    if item_key not in ITEMS:
+        line_reply(reply_token, [msg_text("品項不存在～請重新選擇。")])
+        return
+
+    sess.pending_item = item_key
+    sess.pending_flavor = None
 
-        sess["state"] = "WAIT_PICKUP_METHOD"
-        line_reply(reply_token, [msg_flex("取貨方式", flex_pickup_method())])
+    meta = ITEMS[item_key]
+    if meta["has_flavor"]:
+        sess.state = "WAIT_FLAVOR"
+        q = [quick_postback(f, f"PB:FLAVOR:{f}", display_text=f) for f in meta["flavors"]]
+        line_reply(reply_token, [msg_text(f"你選了：{meta['label']}\n請選口味：", quick_items=q)])
         return
 
-    # ITEM
-    if data.startswith("PB:ITEM:"):
-        if not sess["ordering"]:
-            line_reply(reply_token, [msg_text("想下單請先點「我要下單」～\n你也可以點「甜點」先看菜單。")])
-            return
+    sess.state = "WAIT_QTY"
+    max_q = int(meta.get("max_qty", 12))
+    step = int(meta.get("step", 1))
+    q = build_qty_quick(int(meta["min_qty"]), max_q, prefix="PB:QTY:", step=step)
+    line_reply(reply_token, [msg_text(f"你選了：{meta['label']}\n請選數量：", quick_items=q)])
 
-        item_key = data.split("PB:ITEM:", 1)[1].strip()
-        if item_key not in ITEMS:
-            line_reply(reply_token, [msg_text("品項不存在～請重新選擇。")])
-            return
 
-        sess["pending_item"] = item_key
-        sess["pending_flavor"] = None
+def h_flavor(user_id: str, reply_token: str, sess: Session, arg: str):
+    flavor = arg
+    item_key = sess.pending_item
+    if not item_key or item_key not in ITEMS:
+        line_reply(reply_token, [msg_text("流程好像亂掉了～請點「我要下單」重新開始。")])
+        return
+    if flavor not in ITEMS[item_key]["flavors"]:
+        line_reply(reply_token, [msg_text("口味不正確～請重新選。")])
+        return
 
-        meta = ITEMS[item_key]
-        if meta["has_flavor"]:
-            sess["state"] = "WAIT_FLAVOR"
-            q = [quick_postback(f, f"PB:FLAVOR:{f}", display_text=f) for f in meta["flavors"]]
-            line_reply(reply_token, [msg_text(f"你選了：{meta['label']}\n請選口味：", quick_items=q)])
-            return
-        else:
-            sess["state"] = "WAIT_QTY"
-            max_q = int(meta.get("max_qty", 12))
-            step = int(meta.get("step", 1))
-            q = build_qty_quick(int(meta["min_qty"]), max_q, prefix="PB:QTY:", step=step)
-            line_reply(reply_token, [msg_text(f"你選了：{meta['label']}\n請選數量：", quick_items=q)])
-            return
+    sess.pending_flavor = flavor
+    sess.state = "WAIT_QTY"
+    meta = ITEMS[item_key]
+    max_q = int(meta.get("max_qty", 12))
+    step = int(meta.get("step", 1))
+    q = build_qty_quick(int(meta["min_qty"]), max_q, prefix="PB:QTY:", step=step)
+    line_reply(reply_token, [msg_text(f"口味：{flavor}\n請選數量：", quick_items=q)])
 
-    # FLAVOR
-    if data.startswith("PB:FLAVOR:"):
-        flavor = data.split("PB:FLAVOR:", 1)[1].strip()
-        item_key = sess.get("pending_item")
-        if not item_key or item_key not in ITEMS:
-            line_reply(reply_token, [msg_text("流程好像亂掉了～請點「我要下單」重新開始。")])
-            return
-        if flavor not in ITEMS[item_key]["flavors"]:
-            line_reply(reply_token, [msg_text("口味不正確～請重新選。")])
-            return
 
-        sess["pending_flavor"] = flavor
-        sess["state"] = "WAIT_QTY"
-        meta = ITEMS[item_key]
-        max_q = int(meta.get("max_qty", 12))
-        step = int(meta.get("step", 1))
-        q = build_qty_quick(int(meta["min_qty"]), max_q, prefix="PB:QTY:", step=step)
-        line_reply(reply_token, [msg_text(f"口味：{flavor}\n請選數量：", quick_items=q)])
-        return
-
-    # QTY
-    if data.startswith("PB:QTY:"):
-        qty = int(data.split("PB:QTY:", 1)[1].strip())
-        item_key = sess.get("pending_item")
-        if not item_key or item_key not in ITEMS:
-            line_reply(reply_token, [msg_text("流程好像亂掉了～請點「我要下單」重新開始。")])
-            return
+def h_qty(user_id: str, reply_token: str, sess: Session, arg: str):
+    qty = int(arg)
+    item_key = sess.pending_item
+    if not item_key or item_key not in ITEMS:
+        line_reply(reply_token, [msg_text("流程好像亂掉了～請點「我要下單」重新開始。")])
+        return
 
-        flavor = sess.get("pending_flavor")
-        try:
-            add_to_cart(user_id, item_key, flavor, qty)
-        except Exception as e:
-            line_reply(reply_token, [msg_text(f"加入失敗：{e}")])
-            return
+    flavor = sess.pending_flavor
+    try:
+        add_to_cart(user_id, item_key, flavor, qty)
+    except Exception as e:
+        line_reply(reply_token, [msg_text(f"加入失敗：{e}")])
+        return
 
-        sess["pending_item"] = None
-        sess["pending_flavor"] = None
-        sess["state"] = "IDLE"
-        recalc_cart(sess)
+    sess.pending_item = None
+    sess.pending_flavor = None
+    sess.state = "IDLE"
+    recalc_cart(sess)
 
-        line_reply(reply_token, [
-            msg_text("✅ 已加入購物車"),
-            msg_flex("結帳內容", flex_checkout_summary(sess)),
-        ])
+    line_reply(reply_token, [
+        msg_text("✅ 已加入購物車"),
+        msg_flex("結帳內容", flex_checkout_summary(sess)),
+    ])
+
+
+def h_pickup(user_id: str, reply_token: str, sess: Session, arg: str):
+    method = arg
+    sess.pickup_method = method
+
+    quick_items = build_date_quick_items(load_settings())
+    if not quick_items:
+        line_reply(reply_token, [msg_text("近期可選日期不足（可能都遇到公休/不出貨日）。")])
         return
 
-    # PICKUP METHOD
-    if data.startswith("PB:PICKUP:"):
-        method = data.split("PB:PICKUP:", 1)[1].strip()
-        sess["pickup_method"] = method
+    if method == "店取":
+        sess.state = "WAIT_PICKUP_DATE"
+        line_reply(reply_token, [msg_text("請選「店取日期」（3～14天內，已排除公休）：", quick_items=quick_items)])
+        return
 
-        settings = load_settings()
-        date_buttons = build_available_date_buttons(settings)
-        if not date_buttons:
-            line_reply(reply_token, [msg_text("近期可選日期不足（可能都遇到公休/不出貨日）。")])
-            return
-        quick_items = [quick_postback(lbl, f"PB:DATE:{ymd}", display_text=lbl) for (lbl, ymd) in date_buttons]
+    if method == "宅配":
+        sess.state = "WAIT_DELIVERY_DATE"
+        line_reply(reply_token, [msg_text("請選「期望到貨日」（3～14天內；僅期望日；已排除公休）：", quick_items=quick_items)])
+        return
 
-        if method == "店取":
-            sess["state"] = "WAIT_PICKUP_DATE"
-            line_reply(reply_token, [msg_text("請選「店取日期」（3～14天內，已排除公休）：", quick_items=quick_items)])
-            return
+    reply_flow_mismatch(reply_token)
 
-        if method == "宅配":
-            sess["state"] = "WAIT_DELIVERY_DATE"
-            line_reply(reply_token, [msg_text("請選「期望到貨日」（3～14天內；僅期望日；已排除公休）：", quick_items=quick_items)])
-            return
 
-    # DATE
-    if data.startswith("PB:DATE:"):
-        ymd = data.split("PB:DATE:", 1)[1].strip()
-        settings = load_settings()
-        try:
-            d_obj = datetime.strptime(ymd, "%Y-%m-%d").date()
-            if is_closed(d_obj, settings):
-                line_reply(reply_token, [msg_text("這天是公休/不出貨日～請重新選擇。")])
-                line_reply(reply_token, [msg_flex("取貨方式", flex_pickup_method())])
-                return
-        except:
-            pass
+def h_date(user_id: str, reply_token: str, sess: Session, arg: str):
+    ymd = arg
+    settings = load_settings()
+    if not is_available_date(ymd, settings):
+        # reply token 只能用一次：提示 + 取貨方式卡片一起回
+        line_reply(reply_token, [msg_text("這天是公休/不出貨日～請重新選擇。"), MSG_PICKUP_METHOD])
+        return
 
-        if sess["state"] == "WAIT_PICKUP_DATE":
-            sess["pickup_date"] = ymd
-            sess["state"] = "WAIT_PICKUP_TIME"
-            q = [quick_postback(s, f"PB:TIME:{s}", display_text=s) for s in PICKUP_SLOTS]
-            line_reply(reply_token, [msg_text(f"✅ 已選店取日期：{ymd}\n請選店取時段：", quick_items=q)])
-            return
+    if sess.state == "WAIT_PICKUP_DATE":
+        sess.pickup_date = ymd
+        sess.state = "WAIT_PICKUP_TIME"
+        q = PICKUP_TIME_QUICK
+        line_reply(reply_token, [msg_text(f"✅ 已選店取日期：{ymd}\n請選店取時段：", quick_items=q)])
+        return
 
-        if sess["state"] == "WAIT_DELIVERY_DATE":
-            sess["delivery_date"] = ymd
-            sess["state"] = "WAIT_DELIVERY_NAME"
-            line_reply(reply_token, [msg_text(f"✅ 已選期望到貨日：{ymd}\n請輸入宅配收件人姓名：")])
-            return
+    if sess.state == "WAIT_DELIVERY_DATE":
+        sess.delivery_date = ymd
+        sess.state = "WAIT_DELIVERY_NAME"
+        line_reply(reply_token, [msg_text(f"✅ 已選期望到貨日：{ymd}\n請輸入宅配收件人姓名：")])
+        return
+
+    line_reply(reply_token, [msg_text("我有收到日期，但目前不是選日期的步驟喔～\n請點「前往結帳」再操作一次。")])
+
+
+def h_time(user_id: str, reply_token: str, sess: Session, arg: str):
+    if sess.state != "WAIT_PICKUP_TIME":
+        reply_flow_mismatch(reply_token)
+        return
+    t = arg
+    sess.pickup_time = t
+    sess.state = "WAIT_PICKUP_NAME"
+    line_reply(reply_token, [msg_text(
+        f"✅ 店取資訊已選好：\n日期：{sess.pickup_date}\n時段：{t}\n地址：{PICKUP_ADDRESS}\n\n請輸入取件人姓名："
+    )])
+
+
+def h_phone_ok(user_id: str, reply_token: str, sess: Session, arg: str):
+    kind = arg
+    if kind == "PICKUP":
+        sess.pickup_phone_ok = True
+    elif kind == "DELIVERY":
+        sess.delivery_phone_ok = True
+    else:
+        reply_flow_mismatch(reply_token)
+        return
+    sess.state = "IDLE"
+    line_reply(reply_token, [msg_text("✅ 電話已確認"), msg_flex("結帳內容", flex_checkout_summary(sess))])
 
-        line_reply(reply_token, [msg_text("我有收到日期，但目前不是選日期的步驟喔～\n請點「前往結帳」再操作一次。")])
+
+def h_phone_retry(user_id: str, reply_token: str, sess: Session, arg: str):
+    kind = arg
+    if kind == "PICKUP":
+        sess.pickup_phone = None
+        sess.pickup_phone_ok = False
+        sess.state = "WAIT_PICKUP_PHONE"
+        line_reply(reply_token, [msg_text("請重新輸入店取電話（純數字）：")])
+        return
+    if kind == "DELIVERY":
+        sess.delivery_phone = None
+        sess.delivery_phone_ok = False
+        sess.state = "WAIT_DELIVERY_PHONE"
+        line_reply(reply_token, [msg_text("請重新輸入宅配電話（純數字）：")])
         return
+    reply_flow_mismatch(reply_token)
 
-    # TIME
-    if data.startswith("PB:TIME:") and sess["state"] == "WAIT_PICKUP_TIME":
-        t = data.split("PB:TIME:", 1)[1].strip()
-        sess["pickup_time"] = t
-        sess["state"] = "WAIT_PICKUP_NAME"
-        line_reply(reply_token, [msg_text(
-            f"✅ 店取資訊已選好：\n日期：{sess.get('pickup_date')}\n時段：{t}\n地址：{PICKUP_ADDRESS}\n\n請輸入取件人姓名："
-        )])
+
+def h_edit_menu(user_id: str, reply_token: str, sess: Session, arg: str):
+    if not sess.cart:
+        line_reply(reply_token, [msg_text("購物車是空的～沒有東西可以改。")])
         return
+    sess.state = "EDIT_MENU"
+    q = [
+        quick_postback("➕ 增加數量", "PB:EDITMODE:INC", display_text="增加數量"),
+        quick_postback("➖ 減少數量", "PB:EDITMODE:DEC", display_text="減少數量"),
+        quick_postback("🗑 移除品項", "PB:EDITMODE:DEL", display_text="移除品項"),
+        quick_postback("🍵 修改口味", "PB:EDITMODE:FLAVOR", display_text="修改口味"),
+    ]
+    line_reply(reply_token, [msg_text("想怎麼修改呢？", quick_items=q)])
 
-    # PHONE CONFIRM
-    if data.startswith("PB:PHONE_OK:"):
-        kind = data.split("PB:PHONE_OK:", 1)[1].strip()
-        if kind == "PICKUP":
-            sess["pickup_phone_ok"] = True
-            sess["state"] = "IDLE"
-            line_reply(reply_token, [msg_text("✅ 電話已確認"), msg_flex("結帳內容", flex_checkout_summary(sess))])
-            return
-        if kind == "DELIVERY":
-            sess["delivery_phone_ok"] = True
-            sess["state"] = "IDLE"
-            line_reply(reply_token, [msg_text("✅ 電話已確認"), msg_flex("結帳內容", flex_checkout_summary(sess))])
-            return
 
-    if data.startswith("PB:PHONE_RETRY:"):
-        kind = data.split("PB:PHONE_RETRY:", 1)[1].strip()
-        if kind == "PICKUP":
-            sess["pickup_phone"] = None
-            sess["pickup_phone_ok"] = False
-            sess["state"] = "WAIT_PICKUP_PHONE"
-            line_reply(reply_token, [msg_text("請重新輸入店取電話（純數字）：")])
-            return
-        if kind == "DELIVERY":
-            sess["delivery_phone"] = None
-            sess["delivery_phone_ok"] = False
-            sess["state"] = "WAIT_DELIVERY_PHONE"
-            line_reply(reply_token, [msg_text("請重新輸入宅配電話（純數字）：")])
-            return
+def h_editmode(user_id: str, reply_token: str, sess: Session, arg: str):
+    mode = arg
+    sess.edit_mode = mode
+    sess.state = "EDIT_PICK_ITEM"
+    q = build_cart_item_choices(sess, mode)
+    line_reply(reply_token, [msg_text("請選要修改的品項：", quick_items=q)])
 
-    # EDIT MENU
-    if data == "PB:EDIT:MENU":
-        if not sess["cart"]:
-            line_reply(reply_token, [msg_text("購物車是空的～沒有東西可以改。")])
-            return
-        sess["state"] = "EDIT_MENU"
-        q = [
-            quick_postback("➕ 增加數量", "PB:EDITMODE:INC", display_text="增加數量"),
-            quick_postback("➖ 減少數量", "PB:EDITMODE:DEC", display_text="減少數量"),
-            quick_postback("🗑 移除品項", "PB:EDITMODE:DEL", display_text="移除品項"),
-            quick_postback("🍵 修改口味", "PB:EDITMODE:FLAVOR", display_text="修改口味"),
-        ]
-        line_reply(reply_token, [msg_text("想怎麼修改呢？", quick_items=q)])
+
+def h_edit(user_id: str, reply_token: str, sess: Session, arg: str):
+    if arg == "MENU":
+        h_edit_menu(user_id, reply_token, sess, arg)
         return
 
-    if data.startswith("PB:EDITMODE:"):
-        mode = data.split("PB:EDITMODE:", 1)[1].strip()
-        sess["edit_mode"] = mode
-        sess["state"] = "EDIT_PICK_ITEM"
-        q = build_cart_item_choices(sess, mode)
-        line_reply(reply_token, [msg_text("請選要修改的品項：", quick_items=q)])
+    mode, _, idx_s = arg.partition(":")
+    if not idx_s or ":" in idx_s:
+        line_reply(reply_token, [msg_text("修改指令好像怪怪的～請再試一次。")])
         return
+    mode = mode.strip()
+    idx = int(idx_s.strip())
 
-    if data.startswith("PB:EDIT:"):
-        parts = data.split(":")
-        if len(parts) != 4:
-            line_reply(reply_token, [msg_text("修改指令好像怪怪的～請再試一次。")])
-            return
-        mode = parts[2].strip()
-        idx = int(parts[3].strip())
+    if idx < 0 or idx >= len(sess.cart):
+        line_reply(reply_token, [msg_text("找不到該品項～請重新選。")])
+        return
 
-        if idx < 0 or idx >= len(sess["cart"]):
-            line_reply(reply_token, [msg_text("找不到該品項～請重新選。")])
-            return
+    x = sess.cart[idx]
+    item_key = x.item_key
+    step = int(ITEMS[item_key].get("step", 1))
 
-        x = sess["cart"][idx]
-        item_key = x["item_key"]
-        step = int(ITEMS[item_key].get("step", 1))
-
-        if mode == "INC":
-            new_qty = x["qty"] + step
-            max_qty = int(ITEMS[item_key].get("max_qty", 999))
-            if new_qty > max_qty:
-                line_reply(reply_token, [msg_text(f"此品項最多 {max_qty}，不能再加囉～")])
-                return
-            x["qty"] = new_qty
-
-        elif mode == "DEC":
-            new_qty = x["qty"] - step
-            if not can_dec_item(item_key, new_qty):
-                line_reply(reply_token, [msg_text(f"此品項最低數量為 {ITEMS[item_key]['min_qty']}，不能再減囉～")])
-                return
-            x["qty"] = new_qty
-
-        elif mode == "DEL":
-            sess["cart"].pop(idx)
-
-        elif mode == "FLAVOR":
-            if not ITEMS[item_key]["has_flavor"]:
-                line_reply(reply_token, [msg_text("這個品項沒有口味可以改～")])
-                return
-            sess["state"] = "WAIT_EDIT_FLAVOR"
-            sess["pending_item"] = item_key
-            sess["pending_flavor"] = idx  # 借放 idx
-            q = [quick_postback(f, f"PB:SETFLAVOR:{f}", display_text=f) for f in ITEMS[item_key]["flavors"]]
-            line_reply(reply_token, [msg_text("請選新口味：", quick_items=q)])
+    if mode == "INC":
+        new_qty = x.qty + step
+        max_qty = int(ITEMS[item_key].get("max_qty", 999))
+        if new_qty > max_qty:
+            line_reply(reply_token, [msg_text(f"此品項最多 {max_qty}，不能再加囉～")])
             return
+        x.set_qty(new_qty)
 
-        else:
-            line_reply(reply_token, [msg_text("我不太懂你想怎麼改～再試一次？")])
+    elif mode == "DEC":
+        new_qty = x.qty - step
+        if not can_dec_item(item_key, new_qty):
+            line_reply(reply_token, [msg_text(f"此品項最低數量為 {ITEMS[item_key]['min_qty']}，不能再減囉～")])
             return
+        x.set_qty(new_qty)
 
-        recalc_cart(sess)
-        sess["state"] = "IDLE"
-        sess["edit_mode"] = None
+    elif mode == "DEL":
+        sess.cart.pop(idx)
 
-        if not sess["cart"]:
-            line_reply(reply_token, [msg_text("✅ 已更新～購物車目前是空的。"), msg_flex("甜點菜單", flex_product_menu(ordering=True))])
+    elif mode == "FLAVOR":
+        if not ITEMS[item_key]["has_flavor"]:
+            line_reply(reply_token, [msg_text("這個品項沒有口味可以改～")])
             return
+        sess.state = "WAIT_EDIT_FLAVOR"
+        sess.pending_item = item_key
+        sess.pending_flavor = idx  # 借放 idx
+        q = [quick_postback(f, f"PB:SETFLAVOR:{f}", display_text=f) for f in ITEMS[item_key]["flavors"]]
+        line_reply(reply_token, [msg_text("請選新口味：", quick_items=q)])
+        return
+
+    else:
+        line_reply(reply_token, [msg_text("我不太懂你想怎麼改～再試一次？")])
+        return
+
+    recalc_cart(sess)
+    sess.state = "IDLE"
+    sess.edit_mode = None
+
+    if not sess.cart:
+        line_reply(reply_token, [msg_text("✅ 已更新～購物車目前是空的。"), MSG_PRODUCT_MENU])
+        return
 
-        line_reply(reply_token, [msg_text("✅ 已更新結帳內容"), msg_flex("結帳內容", flex_checkout_summary(sess))])
+    line_reply(reply_token, [msg_text("✅ 已更新結帳內容"), msg_flex("結帳內容", flex_checkout_summary(sess))])
+
+
+def h_setflavor(user_id: str, reply_token: str, sess: Session, arg: str):
+    if sess.state != "WAIT_EDIT_FLAVOR":
+        reply_flow_mismatch(reply_token)
+        return
+    new_flavor = arg
+    idx = sess.pending_flavor
+    if idx is None or not isinstance(idx, int) or idx < 0 or idx >= len(sess.cart):
+        line_reply(reply_token, [msg_text("口味更新失敗～請重新操作。")])
         return
+    sess.cart[idx].flavor = new_flavor
+    sess.state = "IDLE"
+    sess.pending_item = None
+    sess.pending_flavor = None
+    recalc_cart(sess)
+    line_reply(reply_token, [msg_text("✅ 口味已更新"), msg_flex("結帳內容", flex_checkout_summary(sess))])
 
-    if data.startswith("PB:SETFLAVOR:") and sess.get("state") == "WAIT_EDIT_FLAVOR":
-        new_flavor = data.split("PB:SETFLAVOR:", 1)[1].strip()
-        idx = sess.get("pending_flavor")
-        if idx is None or not isinstance(idx, int) or idx < 0 or idx >= len(sess["cart"]):
-            line_reply(reply_token, [msg_text("口味更新失敗～請重新操作。")])
+
+def h_next(user_id: str, reply_token: str, sess: Session, arg: str):
+    if not sess.cart:
+        line_reply(reply_token, [msg_text("購物車是空的～先選商品喔")])
+        return
+
+    if not sess.pickup_method:
+        sess.state = "WAIT_PICKUP_METHOD"
+        line_reply(reply_token, [MSG_PICKUP_METHOD])
+        return
+
+    if sess.pickup_method == "店取":
+        if not sess.pickup_date:
+            sess.state = "WAIT_PICKUP_DATE"
+            q = build_date_quick_items(load_settings())
+            line_reply(reply_token, [msg_text("請選店取日期：", quick_items=q)])
+            return
+        if not sess.pickup_time:
+            sess.state = "WAIT_PICKUP_TIME"
+            q = PICKUP_TIME_QUICK
+            line_reply(reply_token, [msg_text("請選店取時段：", quick_items=q)])
+            return
+        if not sess.pickup_name:
+            sess.state = "WAIT_PICKUP_NAME"
+            line_reply(reply_token, [msg_text("請輸入取件人姓名：")])
             return
-        sess["cart"][idx]["flavor"] = new_flavor
-        sess["state"] = "IDLE"
-        sess["pending_item"] = None
-        sess["pending_flavor"] = None
-        recalc_cart(sess)
-        line_reply(reply_token, [msg_text("✅ 口味已更新"), msg_flex("結帳內容", flex_checkout_summary(sess))])
-        return
-
-    # NEXT（建單）
-    if data == "PB:NEXT":
-        if not sess["cart"]:
-            line_reply(reply_token, [msg_text("購物車是空的～先選商品喔")])
+        if not sess.pickup_phone:
+            sess.state = "WAIT_PICKUP_PHONE"
+            line_reply(reply_token, [msg_text("請輸入店取電話（純數字）：")])
+            return
+        if not sess.pickup_phone_ok:
+            line_reply(reply_token, [msg_flex("電話確認", flex_phone_confirm(sess.pickup_phone, "PICKUP"))])
             return
 
-        if not sess.get("pickup_method"):
-            sess["state"] = "WAIT_PICKUP_METHOD"
-            line_reply(reply_token, [msg_flex("取貨方式", flex_pickup_method())])
+    if sess.pickup_method == "宅配":
+        if not sess.delivery_date:
+            sess.state = "WAIT_DELIVERY_DATE"
+            q = build_date_quick_items(load_settings())
+            line_reply(reply_token, [msg_text("請選期望到貨日：", quick_items=q)])
+            return
+        if not sess.delivery_name:
+            sess.state = "WAIT_DELIVERY_NAME"
+            line_reply(reply_token, [msg_text("請輸入宅配收件人姓名：")])
+            return
+        if not sess.delivery_phone:
+            sess.state = "WAIT_DELIVERY_PHONE"
+            line_reply(reply_token, [msg_text("請輸入宅配電話（純數字）：")])
+            return
+        if not sess.delivery_phone_ok:
+            line_reply(reply_token, [msg_flex("電話確認", flex_phone_confirm(sess.delivery_phone, "DELIVERY"))])
+            return
+        if not sess.delivery_address:
+            sess.state = "WAIT_DELIVERY_ADDRESS"
+            line_reply(reply_token, [msg_text("請輸入宅配地址（完整地址）：")])
             return
 
-        if sess["pickup_method"] == "店取":
-            if not sess.get("pickup_date"):
-                sess["state"] = "WAIT_PICKUP_DATE"
-                settings = load_settings()
-                date_buttons = build_available_date_buttons(settings)
-                q = [quick_postback(lbl, f"PB:DATE:{ymd}", display_text=lbl) for (lbl, ymd) in date_buttons]
-                line_reply(reply_token, [msg_text("請選店取日期：", quick_items=q)])
-                return
-            if not sess.get("pickup_time"):
-                sess["state"] = "WAIT_PICKUP_TIME"
-                q = [quick_postback(s, f"PB:TIME:{s}", display_text=s) for s in PICKUP_SLOTS]
-                line_reply(reply_token, [msg_text("請選店取時段：", quick_items=q)])
-                return
-            if not sess.get("pickup_name"):
-                sess["state"] = "WAIT_PICKUP_NAME"
-                line_reply(reply_token, [msg_text("請輸入取件人姓名：")])
-                return
-            if not sess.get("pickup_phone"):
-                sess["state"] = "WAIT_PICKUP_PHONE"
-                line_reply(reply_token, [msg_text("請輸入店取電話（純數字）：")])
-                return
-            if not sess.get("pickup_phone_ok"):
-                line_reply(reply_token, [msg_flex("電話確認", flex_phone_confirm(sess["pickup_phone"], "PICKUP"))])
-                return
-
-        if sess["pickup_method"] == "宅配":
-            if not sess.get("delivery_date"):
-                sess["state"] = "WAIT_DELIVERY_DATE"
-                settings = load_settings()
-                date_buttons = build_available_date_buttons(settings)
-                q = [quick_postback(lbl, f"PB:DATE:{ymd}", display_text=lbl) for (lbl, ymd) in date_buttons]
-                line_reply(reply_token, [msg_text("請選期望到貨日：", quick_items=q)])
-                return
-            if not sess.get("delivery_name"):
-                sess["state"] = "WAIT_DELIVERY_NAME"
-                line_reply(reply_token, [msg_text("請輸入宅配收件人姓名：")])
-                return
-            if not sess.get("delivery_phone"):
-                sess["state"] = "WAIT_DELIVERY_PHONE"
-                line_reply(reply_token, [msg_text("請輸入宅配電話（純數字）：")])
-                return
-            if not sess.get("delivery_phone_ok"):
-                line_reply(reply_token, [msg_flex("電話確認", flex_phone_confirm(sess["delivery_phone"], "DELIVERY"))])
-                return
-            if not sess.get("delivery_address"):
-                sess["state"] = "WAIT_DELIVERY_ADDRESS"
-                line_reply(reply_token, [msg_text("請輸入宅配地址（完整地址）：")])
-                return
-
-        # 建單
-        order_id = gen_order_id()
-
-        okA = write_order_A(user_id, order_id, sess)
-        okB = write_order_B(order_id, sess)
-        okC = write_order_C_order(order_id, sess)                 # ✅ c_log
-        okF = write_order_cashflow_order(order_id, sess)          # ✅ cashflow
-
-        total = cart_total(sess["cart"])
-        fee = shipping_fee(total) if sess["pickup_method"] == "宅配" else 0
-        grand = total + fee
-        summary_lines = "\n".join([f"• {find_cart_line_label(x)}" for x in sess["cart"]])
-
-        if sess["pickup_method"] == "店取":
-            customer_msg = (
-                "✅ 訂單已建立（待轉帳）\n"
-                f"訂單編號：{order_id}\n\n"
-                f"{summary_lines}\n\n"
-                "【店取資訊】\n"
-                f"日期：{sess['pickup_date']}\n"
-                f"時段：{sess['pickup_time']}\n"
-                f"取件人：{sess['pickup_name']}\n"
-                f"電話：{sess['pickup_phone']}\n"
-                f"地址：{PICKUP_ADDRESS}\n\n"
-                f"小計：NT${total}\n\n"
-                + BANK_TRANSFER_TEXT
-            )
-        else:
-            customer_msg = (
-                "✅ 訂單已建立（待轉帳）\n"
-                f"訂單編號：{order_id}\n\n"
-                f"{summary_lines}\n\n"
-                "【宅配資訊】\n"
-                f"期望到貨日：{sess['delivery_date']}（不保證準時）\n"
-                f"收件人：{sess['delivery_name']}\n"
-                f"電話：{sess['delivery_phone']}\n"
-                f"地址：{sess['delivery_address']}\n\n"
-                f"小計：NT${total}\n運費：NT${fee}\n應付：NT${grand}\n\n"
-                + DELIVERY_NOTICE
-                + "\n\n"
-                + BANK_TRANSFER_TEXT
-            )
-
-        line_reply(reply_token, [msg_text(customer_msg)])
-
-        # 新訂單通知（只給管理員）
-        if ADMIN_USER_IDS:
-            method = sess["pickup_method"]
-            admin_card = msg_flex("新訂單提醒", flex_admin_order_actions(order_id, method, current_status="UNPAID"))
-            for admin_uid in ADMIN_USER_IDS:
-                line_push(admin_uid, [admin_card])
-
-        # 如果寫入失敗也不要噴 debug 給客人（只提醒商家去看）
-        if not (okA and okB and okC and okF) and ADMIN_USER_IDS and user_id in ADMIN_USER_IDS:
-            line_reply(reply_token, [msg_text("提醒：表單寫入可能有問題，請檢查 Sheet 名稱/權限/欄位。")])
+    # 建單
+    order_id = gen_order_id()
+    created_at = now_str()  # A/B/C/cashflow 同一筆訂單用同一個時間
+
+    # 這裡只是排進寫入佇列；真的寫不進 Sheet 時由 flusher 寫 dead-letter 檔並推播提醒管理員（不噴 debug 給客人）
+    okA = write_order_A(user_id, order_id, sess, created_at)
+    okB = write_order_B(order_id, sess, created_at)
+    okC = write_order_C_order(order_id, sess, created_at)                 # ✅ c_log
+    okF = write_order_cashflow_order(order_id, sess, created_at)          # ✅ cashflow
+    if not (okA and okB and okC and okF):
+        # 連佇列都排不進去（GSHEET_ID/憑證沒設定）：列已經存進 dead-letter 檔，這裡通知管理員手動補登
+        notify_admins_order_not_queued(order_id)
+
+    total = sess.cart_subtotal
+    fee = shipping_fee(total) if sess.pickup_method == "宅配" else 0
+    grand = total + fee
+    summary_lines = "\n".join([f"• {find_cart_line_label(x)}" for x in sess.cart])
+
+    if sess.pickup_method == "店取":
+        customer_msg = (
+            "✅ 訂單已建立（待轉帳）\n"
+            f"訂單編號：{order_id}\n\n"
+            f"{summary_lines}\n\n"
+            "【店取資訊】\n"
+            f"日期：{sess.pickup_date}\n"
+            f"時段：{sess.pickup_time}\n"
+            f"取件人：{sess.pickup_name}\n"
+            f"電話：{sess.pickup_phone}\n"
+            f"地址：{PICKUP_ADDRESS}\n\n"
+            f"小計：NT${total}\n\n"
+            + BANK_TRANSFER_TEXT
+        )
+    else:
+        customer_msg = (
+            "✅ 訂單已建立（待轉帳）\n"
+            f"訂單編號：{order_id}\n\n"
+            f"{summary_lines}\n\n"
+            "【宅配資訊】\n"
+            f"期望到貨日：{sess.delivery_date}（不保證準時）\n"
+            f"收件人：{sess.delivery_name}\n"
+            f"電話：{sess.delivery_phone}\n"
+            f"地址：{sess.delivery_address}\n\n"
+            f"小計：NT${total}\n運費：NT${fee}\n應付：NT${grand}\n\n"
+            + DELIVERY_NOTICE
+            + "\n\n"
+            + BANK_TRANSFER_TEXT
+        )
+
+    line_reply(reply_token, [msg_text(customer_msg)])
+
+    # 新訂單通知（只給管理員）
+    if ADMIN_USER_IDS:
+        method = sess.pickup_method
+        admin_card = msg_flex("新訂單提醒", flex_admin_order_actions(order_id, method, current_status="UNPAID"))
+        run_in_background(line_multicast, ADMIN_USER_IDS, [admin_card])
+
+    reset_session(sess)
+
+
+POSTBACK_HANDLERS = {
+    "PB:RESET": h_reset,
+    "PB:CONTINUE": h_continue,
+    "PB:CHECKOUT": h_checkout,
+    "PB:ITEM": h_item,
+    "PB:FLAVOR": h_flavor,
+    "PB:QTY": h_qty,
+    "PB:PICKUP": h_pickup,
+    "PB:DATE": h_date,
+    "PB:TIME": h_time,
+    "PB:PHONE_OK": h_phone_ok,
+    "PB:PHONE_RETRY": h_phone_retry,
+    "PB:EDIT": h_edit,
+    "PB:EDITMODE": h_editmode,
+    "PB:SETFLAVOR": h_setflavor,
+    "PB:NEXT": h_next,
+}
 
-        reset_session(sess)
+
+def handle_postback(user_id: str, reply_token: str, data: str):
+    sess = get_session(user_id)
+
+    if too_fast_duplicate(sess, data):
         return
 
-    # fallback
-    line_reply(reply_token, [msg_text("我有收到你的操作～但流程沒對上。\n要下單請點「我要下單」。")])
+    # ---- 管理員功能 ----
+    if data.startswith("ADMIN:"):
+        handle_admin_postback(user_id, reply_token, data)
+        return
+
+    key, arg = parse_postback(data)
+    handler = POSTBACK_HANDLERS.get(key)
+    if not handler:
+        reply_flow_mismatch(reply_token)
+        return
+    handler(user_id, reply_token, sess, arg)
 
 
 # =========================
@@ -1660,51 +2667,51 @@ def handle_postback(user_id: str, reply_token: str, data: str):
 def handle_state_text(user_id: str, reply_token: str, text: str):
     sess = get_session(user_id)
 
-    if not sess["ordering"]:
-        line_reply(reply_token, [msg_flex("提示", flex_home_hint())])
+    if not sess.ordering:
+        line_reply(reply_token, [MSG_HOME_HINT])
         return
 
-    if sess["state"] == "WAIT_PICKUP_NAME":
-        sess["pickup_name"] = text.strip()
-        sess["state"] = "WAIT_PICKUP_PHONE"
+    if sess.state == "WAIT_PICKUP_NAME":
+        sess.pickup_name = text.strip()
+        sess.state = "WAIT_PICKUP_PHONE"
         line_reply(reply_token, [msg_text("請輸入店取電話（純數字）：")])
         return
 
-    if sess["state"] == "WAIT_PICKUP_PHONE":
+    if sess.state == "WAIT_PICKUP_PHONE":
         if not is_phone_digits(text):
             line_reply(reply_token, [msg_text("電話格式看起來不對～請輸入純數字（例如 09xxxxxxxx）。")])
             return
-        sess["pickup_phone"] = text.strip()
-        sess["pickup_phone_ok"] = False
-        sess["state"] = "IDLE"
+        sess.pickup_phone = text.strip()
+        sess.pickup_phone_ok = False
+        sess.state = "IDLE"
         line_reply(reply_token, [
             msg_text("已收到店取電話～請二次確認："),
-            msg_flex("電話確認", flex_phone_confirm(sess["pickup_phone"], "PICKUP"))
+            msg_flex("電話確認", flex_phone_confirm(sess.pickup_phone, "PICKUP"))
         ])
         return
 
-    if sess["state"] == "WAIT_DELIVERY_NAME":
-        sess["delivery_name"] = text.strip()
-        sess["state"] = "WAIT_DELIVERY_PHONE"
+    if sess.state == "WAIT_DELIVERY_NAME":
+        sess.delivery_name = text.strip()
+        sess.state = "WAIT_DELIVERY_PHONE"
         line_reply(reply_token, [msg_text("請輸入宅配電話（純數字）：")])
         return
 
-    if sess["state"] == "WAIT_DELIVERY_PHONE":
+    if sess.state == "WAIT_DELIVERY_PHONE":
         if not is_phone_digits(text):
             line_reply(reply_token, [msg_text("電話格式看起來不對～請輸入純數字（例如 09xxxxxxxx）。")])
             return
-        sess["delivery_phone"] = text.strip()
-        sess["delivery_phone_ok"] = False
-        sess["state"] = "IDLE"
+        sess.delivery_phone = text.strip()
+        sess.delivery_phone_ok = False
+        sess.state = "IDLE"
         line_reply(reply_token, [
             msg_text("已收到宅配電話～請二次確認："),
-            msg_flex("電話確認", flex_phone_confirm(sess["delivery_phone"], "DELIVERY"))
+            msg_flex("電話確認", flex_phone_confirm(sess.delivery_phone, "DELIVERY"))
         ])
         return
 
-    if sess["state"] == "WAIT_DELIVERY_ADDRESS":
-        sess["delivery_address"] = text.strip()
-        sess["state"] = "IDLE"
+    if sess.state == "WAIT_DELIVERY_ADDRESS":
+        sess.delivery_address = text.strip()
+        sess.state = "IDLE"
         line_reply(reply_token, [msg_text("✅ 已收到宅配地址"), msg_flex("結帳內容", flex_checkout_summary(sess))])
         return
 